@@ -8,10 +8,15 @@ import re
 from configobj import ConfigObj
 from subprocess import call, CalledProcessError
 
+from darwinist.mounts import MountTableCache
+
 re_mountpoint = re.compile(r'^/Volumes/[A-Za-z0-9_-]*$')
 
 DEFAULT_CONFIG_PATH = os.path.join(os.getenv('HOME'), '.afpshares.conf')
 
+# Cached mountpoint status strings, invalidated when the mount table changes
+AFP_STATUS_CACHE = MountTableCache()
+
 
 class AFPShareError(Exception):
     """
@@ -126,7 +131,12 @@ class AFPShareDisk(dict):
         Return status of mountpoint as string:
 
         'not mounted', 'mounted by other user', 'mounted by myself'
+
+        The status is cached until the mount table changes.
         """
+        return AFP_STATUS_CACHE.lookup(self.mountpoint, self.__check_status__)
+
+    def __check_status__(self):
         if not os.path.ismount(self.mountpoint):
             return 'not mounted'
 
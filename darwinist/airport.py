@@ -2,97 +2,679 @@
 Module for Apple OS/X airport status command access from python
 """
 
+from collections import deque
 from operator import itemgetter
 import os
+import plistlib
+import threading
+import time
 from subprocess import check_output, CalledProcessError
+from xml.parsers.expat import ExpatError
+
+from darwinist.ringbuffer import RingBuffer
 
 AIRPORT_BINARY = '/System/Library/PrivateFrameworks/Apple80211.framework/Versions/Current/Resources/airport'
 
+# Channel flag bits in 'airport -s -x' scan results
+CHANNEL_FLAG_WIDTHS = (
+    (0x800, 160),
+    (0x400, 80),
+    (0x4, 40),
+    (0x2, 20),
+)
+CHANNEL_FLAG_2GHZ = 0x8
+CHANNEL_FLAG_5GHZ = 0x10
+
+# VHT_CHAN_WIDTH values in VHT operation information element
+VHT_CHANNEL_WIDTHS = {
+    1: 80,
+    2: 160,
+    3: 160,
+}
+
+# RSN authentication key management suite types
+RSN_AUTH_SELECTORS = {
+    1: 'WPA2 Enterprise',
+    2: 'WPA2 Personal',
+    5: 'WPA2 Enterprise',
+    6: 'WPA2 Personal',
+    8: 'WPA3 Personal',
+    12: 'WPA3 Enterprise',
+}
+
+CAPABILITY_PRIVACY = 0x10
+
+# Numeric 'airport -I' fields recorded by AirportMonitor with buffer names
+AIRPORT_MONITOR_FIELDS = {
+    'agrCtlRSSI':   'rssi',
+    'agrCtlNoise':  'noise',
+    'lastTxRate':   'txrate',
+}
+AIRPORT_MONITOR_KEYS = frozenset(list(AIRPORT_MONITOR_FIELDS.keys()) + ['BSSID', 'SSID'])
+
+# Seconds AirportStatus uses a probed snapshot before probing again
+DEFAULT_STATUS_TTL = 5
+
+DEFAULT_MONITOR_SIZE = 600
+DEFAULT_MONITOR_INTERVAL = 1
+DEFAULT_MONITOR_PERCENTILES = (5, 50, 95)
+
+BAND_2GHZ = '2.4GHz'
+BAND_5GHZ = '5GHz'
+
+# Channel congestion analysis parameters
+DEFAULT_SURVEY_SCANS = 5
+DEFAULT_SURVEY_INTERVAL = 2
+CONGESTION_RSSI_FLOOR = -95
+CHANNEL_OVERLAP_2GHZ = 4
+CANDIDATE_CHANNELS = {
+    BAND_2GHZ: (1, 6, 11),
+    BAND_5GHZ: (36, 40, 44, 48, 149, 153, 157, 161, 165),
+}
+
 
 class AirportError(Exception):
     pass
 
 
+def format_bssid(value):
+    """
+    Return BSSID as upper case zero padded hex digits separated with colons
+    """
+    try:
+        return ':'.join(['%02X' % int(x, 16) for x in value.split(':')])
+    except ValueError:
+        raise AirportError('Invalid BSSID: {0}'.format(value))
+
+
+def bssid_to_int(value):
+    """
+    Return BSSID as 48 bit integer
+    """
+    try:
+        return int(''.join('%02x' % int(x, 16) for x in value.split(':')), 16)
+    except ValueError:
+        raise AirportError('Invalid BSSID: {0}'.format(value))
+
+
+def int_to_bssid(value):
+    """
+    Return 48 bit integer as formatted BSSID
+    """
+    return ':'.join('%02X' % ((value >> shift) & 0xff) for shift in range(40, -8, -8))
+
+
+def parse_status(data, keys=None):
+    """
+    Parse 'airport -I' output to dictionary of string values
+
+    If keys is given, only lines with these keys are stored.
+    """
+    status = {}
+    for line in data.splitlines():
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+
+        try:
+            key, value = line.split(':', 1)
+        except ValueError:
+            raise AirportError('Error parsing line: {0}'.format(line))
+
+        key = key.strip()
+        if keys is None or key in keys:
+            status[key] = value.strip()
+    return status
+
+
+def channel_band(channel, flags=None):
+    """
+    Return frequency band for channel number and optional channel flags
+    """
+    if flags is not None:
+        if flags & CHANNEL_FLAG_2GHZ:
+            return BAND_2GHZ
+        if flags & CHANNEL_FLAG_5GHZ:
+            return BAND_5GHZ
+    if channel is None:
+        return None
+    if channel <= 14:
+        return BAND_2GHZ
+    return BAND_5GHZ
+
+
+class AirportNetwork(dict):
+    """
+    Network found in airport scan
+
+    Parsed from one 'airport -s -x' plist item. Keys SSID, BSSID, RSSI and
+    CHANNEL match the items returned by AirportStatus.proximity(), in
+    addition to typed NOISE, BAND, WIDTH and SECURITY fields.
+    """
+    def __init__(self, details):
+        self.details = details
+
+        channel = details.get('CHANNEL', None)
+        flags = details.get('CHANNEL_FLAGS', None)
+        self['SSID'] = details.get('SSID_STR', '')
+        self['BSSID'] = format_bssid(details.get('BSSID', ''))
+        self['RSSI'] = details.get('RSSI', None)
+        self['NOISE'] = details.get('NOISE', None)
+        self['CHANNEL'] = channel is not None and int(channel) or None
+        self['BAND'] = channel_band(self['CHANNEL'], flags)
+        self['WIDTH'] = self.__parse_width__(flags)
+        self['SECURITY'] = self.__parse_security__()
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError('No such AirportNetwork attribute: {0}'.format(attr))
+
+    def __repr__(self):
+        return '{0} {1} channel {2} {3} dB'.format(self.BSSID, self.SSID, self.CHANNEL, self.RSSI)
+
+    def __parse_width__(self, flags):
+        if flags is not None:
+            for flag, width in CHANNEL_FLAG_WIDTHS:
+                if flags & flag:
+                    return width
+
+        vht = self.details.get('VHT_IE', {})
+        if vht.get('VHT_CHAN_WIDTH', 0) in VHT_CHANNEL_WIDTHS:
+            return VHT_CHANNEL_WIDTHS[vht['VHT_CHAN_WIDTH']]
+
+        ht = self.details.get('HT_IE', {})
+        if ht.get('HT_STA_CHAN_WIDTH', 0):
+            return 40
+        return 20
+
+    def __parse_security__(self):
+        if 'RSN_IE' in self.details:
+            selectors = self.details['RSN_IE'].get('IE_KEY_RSN_AUTHSELS', [])
+            modes = sorted(set(RSN_AUTH_SELECTORS.get(x, 'WPA2') for x in selectors))
+            if not modes:
+                return 'WPA2'
+            return '/'.join(modes)
+
+        if 'WPA_IE' in self.details:
+            return 'WPA'
+
+        if self.details.get('CAPABILITIES', 0) & CAPABILITY_PRIVACY:
+            return 'WEP'
+
+        return 'Open'
+
+
+class AirportScan(list):
+    """
+    Networks visible in one airport scan
+
+    Networks are indexed by BSSID and SSID. Scan data from 'airport -s -x'
+    plist output can be given for parsing instead of running the command.
+    """
+    def __init__(self, ssid=None, data=None):
+        self.ssid = ssid
+        self.bssids = {}
+        self.ssids = {}
+
+        if data is None:
+            cmd = [AIRPORT_BINARY, '-s', '-x']
+            if ssid is not None:
+                cmd.insert(2, ssid)
+            try:
+                data = check_output(cmd)
+            except CalledProcessError as e:
+                raise AirportError('Error running {0}: {1}'.format(' '.join(cmd), e))
+
+        try:
+            items = plistlib.loads(data)
+        except (ExpatError, ValueError):
+            raise AirportError('Error parsing scan results: {0}'.format(data))
+
+        for details in items:
+            if 'BSSID' not in details:
+                continue
+            network = AirportNetwork(details)
+            self.append(network)
+            self.bssids[network.BSSID] = network
+            self.ssids.setdefault(network.SSID, []).append(network)
+
+    def find_bssid(self, bssid):
+        """
+        Return network with BSSID or None
+        """
+        try:
+            return self.bssids.get(format_bssid(bssid), None)
+        except AirportError:
+            return None
+
+    def find_ssid(self, ssid):
+        """
+        Return list of networks with SSID, strongest signal first
+        """
+        return sorted(self.ssids.get(ssid, []), key=lambda x: -(x.RSSI or -1000))
+
+
+class ChannelLoad(object):
+    """
+    Accumulated scan results for one channel or band
+
+    AP count is the number of distinct BSSIDs seen. Load is the sum of
+    signal weights of all scan results divided by number of scans, where
+    weight grows linearly from 0 at CONGESTION_RSSI_FLOOR to 1 at 0 dBm.
+    """
+    def __init__(self, name, band):
+        self.name = name
+        self.band = band
+        self.bssids = set()
+        self.weight = 0.0
+        self.results = 0
+        self.scans = 0
+        self.overlap = 0.0
+
+    def __repr__(self):
+        return '{0} {1:d} APs load {2:.2f} overlap {3:.2f}'.format(self.name, self.ap_count, self.load, self.overlap)
+
+    def add(self, network):
+        """
+        Add one network from a scan
+        """
+        self.bssids.add(network.BSSID)
+        self.results += 1
+        if network.RSSI is not None:
+            self.weight += max(network.RSSI - CONGESTION_RSSI_FLOOR, 0) / float(-CONGESTION_RSSI_FLOOR)
+
+    @property
+    def ap_count(self):
+        return len(self.bssids)
+
+    @property
+    def load(self):
+        if not self.scans:
+            return 0.0
+        return self.weight / self.scans
+
+    @property
+    def congestion(self):
+        """
+        Load including overlapping adjacent channels
+        """
+        return self.load + self.overlap
+
+
+class ChannelCongestion(object):
+    """
+    Channel congestion analysis over repeated airport scans
+
+    Scans are folded into per channel and per band ChannelLoad histograms
+    one at a time with add_scan(), so scan results are not kept. For 2.4GHz
+    channels the load of channels within CHANNEL_OVERLAP_2GHZ channels is
+    added as overlap, weighted by distance.
+    """
+    def __init__(self):
+        self.scans = 0
+        self.channels = {}
+        self.bands = {}
+
+    def __repr__(self):
+        return 'ChannelCongestion {0:d} scans {1:d} channels'.format(self.scans, len(self.channels))
+
+    def __channel__(self, channel, band):
+        if channel not in self.channels:
+            self.channels[channel] = ChannelLoad(channel, band)
+        return self.channels[channel]
+
+    def add_scan(self, scan):
+        """
+        Fold one AirportScan into the histograms
+        """
+        self.scans += 1
+        for network in scan:
+            if network.CHANNEL is None:
+                continue
+            self.__channel__(network.CHANNEL, network.BAND).add(network)
+            if network.BAND not in self.bands:
+                self.bands[network.BAND] = ChannelLoad(network.BAND, network.BAND)
+            self.bands[network.BAND].add(network)
+
+        for load in list(self.channels.values()) + list(self.bands.values()):
+            load.scans = self.scans
+        self.__update_overlap__()
+
+    def __overlap__(self, channel):
+        """
+        Return distance weighted load of other 2.4GHz channels overlapping channel
+        """
+        overlap = 0.0
+        for other in self.channels.values():
+            distance = abs(other.name - channel)
+            if other.band == BAND_2GHZ and 0 < distance <= CHANNEL_OVERLAP_2GHZ:
+                overlap += other.load * (CHANNEL_OVERLAP_2GHZ + 1 - distance) / (CHANNEL_OVERLAP_2GHZ + 1)
+        return overlap
+
+    def __update_overlap__(self):
+        for load in self.channels.values():
+            if load.band == BAND_2GHZ:
+                load.overlap = self.__overlap__(load.name)
+
+    def survey(self, count=DEFAULT_SURVEY_SCANS, interval=DEFAULT_SURVEY_INTERVAL):
+        """
+        Generator to scan count times every interval seconds
+
+        Yields the analysis after each scan.
+        """
+        for index in range(count):
+            if index:
+                time.sleep(interval)
+            self.add_scan(AirportScan())
+            yield self
+
+    def recommend(self, band=None):
+        """
+        Return list of ChannelLoad for candidate channels, least congested first
+
+        Candidate channels are CANDIDATE_CHANNELS and any channels seen in the
+        scans, optionally limited to band.
+        """
+        candidates = {}
+        for candidate_band, channels in CANDIDATE_CHANNELS.items():
+            for channel in channels:
+                candidates[channel] = candidate_band
+        for channel, load in self.channels.items():
+            candidates[channel] = load.band
+
+        loads = []
+        for channel, candidate_band in candidates.items():
+            if band is not None and candidate_band != band:
+                continue
+            if channel in self.channels:
+                loads.append(self.channels[channel])
+                continue
+
+            load = ChannelLoad(channel, candidate_band)
+            load.scans = self.scans
+            if candidate_band == BAND_2GHZ:
+                load.overlap = self.__overlap__(channel)
+            loads.append(load)
+
+        loads.sort(key=lambda load: (load.congestion, load.ap_count, load.name))
+        return loads
+
+
+class AirportSnapshot(dict):
+    """
+    Read only airport status details from one 'airport -I' call
+
+    Timestamp is the time the probe completed.
+    """
+    def __init__(self, details, timestamp=None):
+        dict.__init__(self, details)
+        self.timestamp = timestamp is not None and timestamp or time.time()
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError('No such AirportSnapshot attribute: {0}'.format(attr))
+
+    def __read_only__(self, *args, **kwargs):
+        raise AirportError('AirportSnapshot is read only')
+
+    __setitem__ = __read_only__
+    __delitem__ = __read_only__
+    clear = __read_only__
+    pop = __read_only__
+    popitem = __read_only__
+    setdefault = __read_only__
+    update = __read_only__
+
+    @property
+    def age(self):
+        """
+        Seconds since snapshot was probed
+        """
+        return time.time() - self.timestamp
+
+
 class AirportStatus(dict):
     """
     Class to call the system 'airport' command.
+
+    Values are read from a cached AirportSnapshot, which is probed again
+    when it is older than ttl seconds or when probe() is called. Threads
+    requesting a probe while another probe is running share its result.
     """
-    def __init__(self):
+    def __init__(self, ttl=DEFAULT_STATUS_TTL):
+        self.ttl = ttl
+        self.__lock__ = threading.Lock()
+        self.__snapshot__ = None
+
         if not os.path.isfile(AIRPORT_BINARY):
             raise AirportError('No such command: {0}'.format(AIRPORT_BINARY))
 
     def __repr__(self):
-        self.probe()
-        return '%(BSSID)s %(SSID)s channel %(channel)s %(agrCtlRSSI)s dB' % self
+        snapshot = self.__snapshot__
+        if snapshot is None:
+            return 'AirportStatus not probed'
+        return '%(BSSID)s %(SSID)s channel %(channel)s %(agrCtlRSSI)s dB' % snapshot
 
     def __getattr__(self, attr):
         try:
-            if not self.keys():
-                self.probe()
-            return self[attr]
-
+            return self.snapshot[attr]
         except KeyError:
             raise AttributeError('No such AirportStatus attribute: {0}'.format(attr))
 
+    def __getitem__(self, key):
+        return self.snapshot[key]
+
+    def __contains__(self, key):
+        return key in self.snapshot
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def get(self, key, default=None):
+        return self.snapshot.get(key, default)
+
+    def keys(self):
+        return self.snapshot.keys()
+
+    def items(self):
+        return self.snapshot.items()
+
+    def values(self):
+        return self.snapshot.values()
+
+    @property
+    def snapshot(self):
+        """
+        Current AirportSnapshot, probed again if older than ttl seconds
+        """
+        snapshot = self.__snapshot__
+        if snapshot is not None and snapshot.age < self.ttl:
+            return snapshot
+        return self.probe()
+
     def probe(self):
         """
         Probe airport status
+
+        Returns new AirportSnapshot. If another thread completed a probe while
+        waiting for it, its snapshot is returned instead of probing again.
         """
-        self.clear()
+        started = time.time()
+        with self.__lock__:
+            snapshot = self.__snapshot__
+            if snapshot is not None and snapshot.timestamp >= started:
+                return snapshot
 
-        cmd = (AIRPORT_BINARY, '-I')
-        try:
-            data = check_output(cmd)
-        except CalledProcessError as e:
-            raise AirportError('Error running {0}: {1}'.format(' '.join(cmd), e))
+            cmd = (AIRPORT_BINARY, '-I')
+            try:
+                data = check_output(cmd)
+            except CalledProcessError as e:
+                raise AirportError('Error running {0}: {1}'.format(' '.join(cmd), e))
 
-        for line in [line.decode('utf-8') for line in data.splitlines()]:
-            if not line.strip():
-                continue
+            details = parse_status(data)
+            for key in ('BSSID',):
+                if key not in details:
+                    continue
+                details[key] = format_bssid(details[key])
 
-            try:
-                key, value = [x.strip() for x in line.split(':', 1)]
-                self[key] = value
-            except ValueError:
-                raise AirportError('Error parsing line: {0}'.format(line))
+            self.__snapshot__ = AirportSnapshot(details)
+            return self.__snapshot__
 
-        for key in ('BSSID',):
-            if key not in self:
-                continue
-            self[key] = ':'.join(['%02x'.upper() % int(x, 16) for x in self[key].split(':')])
+    def monitor(self, size=DEFAULT_MONITOR_SIZE):
+        """
+        Return AirportMonitor for sampling signal levels
+        """
+        return AirportMonitor(size)
 
-    def proximity(self):
+    def scan(self, ssid=None):
+        """
+        Return AirportScan of visible networks, optionally limited to SSID
+        """
+        return AirportScan(ssid)
+
+    def proximity(self, scan=None):
         """
         Return proximity of base stations based on signal levels
+
+        Returns networks with current SSID from scan, sorted by RSSI. A new
+        scan is done if scan is not given.
         """
-        headers = ('SSID', 'BSSID', 'RSSI', 'CHANNEL', 'HT', 'CC', 'SECURITY')
-        aps = []
+        if scan is None:
+            scan = self.scan()
+        aps = list(scan.ssids.get(self.SSID, []))
+        aps.sort(key=itemgetter('RSSI'))
+        return aps
+
+
+class AirportRoamEvent(object):
+    """
+    Change of associated BSSID between two monitor samples
+    """
+    def __init__(self, timestamp, previous, current, ssid=None, rssi=None):
+        self.timestamp = timestamp
+        self.previous = previous
+        self.current = current
+        self.ssid = ssid
+        self.rssi = rssi
+
+    def __repr__(self):
+        return '{0} roamed {1} -> {2}'.format(
+            time.strftime('%H:%M:%S', time.localtime(self.timestamp)),
+            self.previous or 'none',
+            self.current or 'none',
+        )
+
+
+class AirportMonitor(object):
+    """
+    Wi-Fi signal monitor
+
+    Samples 'airport -I' and records RSSI, noise, transmit rate and BSSID to
+    fixed size ring buffers. Only keys in AIRPORT_MONITOR_KEYS are parsed.
+    Missing numeric values are recorded as NaN and BSSID as 0 when not
+    associated. Changes of BSSID are recorded as AirportRoamEvent items.
+    """
+    def __init__(self, size=DEFAULT_MONITOR_SIZE):
+        if not os.path.isfile(AIRPORT_BINARY):
+            raise AirportError('No such command: {0}'.format(AIRPORT_BINARY))
+
+        self.timestamps = RingBuffer(size)
+        self.buffers = dict((name, RingBuffer(size)) for name in AIRPORT_MONITOR_FIELDS.values())
+        self.buffers['bssid'] = RingBuffer(size, typecode='q')
+        self.roaming = deque(maxlen=size)
+        self.ssid = None
 
-        cmd = (AIRPORT_BINARY, '-s', self.SSID)
+    def __repr__(self):
+        return 'AirportMonitor {0:d} samples {1:d} roaming events'.format(len(self.timestamps), len(self.roaming))
+
+    def __getitem__(self, field):
+        return self.buffers[field.lower()]
+
+    @property
+    def bssid(self):
+        """
+        BSSID in latest sample or None
+        """
+        value = self.buffers['bssid'].last
+        if not value:
+            return None
+        return int_to_bssid(int(value))
+
+    def sample(self):
+        """
+        Read airport status and record one sample
+        """
+        cmd = (AIRPORT_BINARY, '-I')
         try:
             data = check_output(cmd)
         except CalledProcessError as e:
             raise AirportError('Error running {0}: {1}'.format(' '.join(cmd), e))
-            return
 
-        for line in [line.decode('utf-8') for line in data.splitlines()]:
-            if not line.strip():
-                continue
+        details = parse_status(data, AIRPORT_MONITOR_KEYS)
+        timestamp = time.time()
+        self.timestamps.append(timestamp)
 
-            line = line.rstrip()
-            if headers[:5] == [x.strip() for x in line.split()][:5]:
-                continue
+        for key, name in AIRPORT_MONITOR_FIELDS.items():
+            try:
+                value = float(details[key])
+            except (KeyError, ValueError):
+                value = float('nan')
+            self.buffers[name].append(value)
 
-            ssid = line[:32].lstrip()
-            bssid = line[33:50].strip("'").upper()
-            rssi = int(line[51:55].strip())
-            channel = int(line[56:58].strip())
-            aps.append({
-                'SSID': ssid,
-                'BSSID': bssid,
-                'RSSI': rssi,
-                'CHANNEL': channel,
-            })
+        previous = self.bssid
+        try:
+            bssid = bssid_to_int(details['BSSID'])
+        except (KeyError, AirportError):
+            bssid = 0
+        self.buffers['bssid'].append(bssid)
+        self.ssid = details.get('SSID', None)
 
-        aps.sort(key=itemgetter('RSSI'))
-        return aps
+        if len(self.timestamps) > 1 and previous != self.bssid:
+            self.roaming.append(AirportRoamEvent(
+                timestamp, previous, self.bssid, self.ssid, self.buffers['rssi'].last
+            ))
+
+        return timestamp
+
+    def statistics(self, field, percentiles=DEFAULT_MONITOR_PERCENTILES):
+        """
+        Return rolling statistics for field as dictionary
+
+        Keys are min, max, mean and pNN for each percentile. NaN values
+        from samples without the field are ignored.
+        """
+        values = RingBuffer(max(len(self[field]), 1))
+        for value in self[field]:
+            if value == value:
+                values.append(value)
+
+        stats = {
+            'min': values.min(),
+            'max': values.max(),
+            'mean': values.mean(),
+        }
+        for percent in percentiles:
+            stats['p{0:d}'.format(percent)] = values.percentile(percent)
+        return stats
+
+    def watch(self, interval=DEFAULT_MONITOR_INTERVAL, count=None):
+        """
+        Generator to sample airport status every interval seconds
+
+        Yields the monitor after each sample. Runs forever unless count is given.
+        """
+        samples = 0
+        while count is None or samples < count:
+            if samples:
+                time.sleep(interval)
+            self.sample()
+            samples += 1
+            yield self
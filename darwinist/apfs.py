@@ -0,0 +1,245 @@
+"""
+APFS container status classes
+
+Parses 'diskutil apfs list -plist' output to container, physical store,
+volume and snapshot objects, indexed by UUID and disk device like the
+coreStorage classes. StorageLayout combines the APFS and CoreStorage
+indexes for host wide lookups.
+"""
+
+import plistlib
+from subprocess import check_output, CalledProcessError
+
+from darwinist.corestorage import StorageIndex, coreStorage
+
+CONTAINER_PLIST_MAP = {
+    'ContainerReference':       'disk',
+    'DesignatedPhysicalStore':  'designated_store',
+    'CapacityCeiling':          'size',
+    'CapacityFree':             'free_space',
+    'Fusion':                   'fusion',
+}
+
+PHYSICAL_STORE_PLIST_MAP = {
+    'DeviceIdentifier':         'disk',
+    'Size':                     'size',
+}
+
+VOLUME_PLIST_MAP = {
+    'DeviceIdentifier':         'disk',
+    'Name':                     'name',
+    'Roles':                    'roles',
+    'CapacityInUse':            'used',
+    'CapacityQuota':            'quota',
+    'CapacityReserve':          'reserve',
+    'Encryption':               'encryption',
+    'FileVault':                'filevault',
+    'Locked':                   'locked',
+    'CryptoMigrationOn':        'crypto_migration',
+}
+
+SNAPSHOT_PLIST_MAP = {
+    'SnapshotName':             'name',
+    'SnapshotXID':              'xid',
+    'Purgeable':                'purgeable',
+}
+
+# Plist keys handled by the hierarchy parser, not copied to item details
+PLIST_STRUCTURE_KEYS = (
+    'APFSContainerUUID',
+    'APFSVolumeUUID',
+    'DiskUUID',
+    'SnapshotUUID',
+    'PhysicalStores',
+    'Volumes',
+    'Snapshots',
+)
+
+
+class APFSError(Exception):
+    pass
+
+
+class APFSContainers(list, StorageIndex):
+    """
+    APFS containers on the host
+    """
+    def __init__(self):
+        self.reset_index()
+        self.update()
+
+    def __str__(self):
+        return '{0:d} containers'.format(len(self))
+
+    def update(self):
+        """
+        Parse output of diskutil apfs list -plist to update data
+        """
+        cmd = ('diskutil', 'apfs', 'list', '-plist')
+        try:
+            data = plistlib.loads(check_output(cmd))
+        except CalledProcessError as e:
+            raise APFSError('Error listing APFS containers: {0}'.format(e))
+        except Exception as e:
+            raise APFSError('Error parsing APFS plist: {0}'.format(e))
+
+        del self[:]
+        self.reset_index()
+
+        for container_data in data.get('Containers', []):
+            container = APFSContainer(container_data)
+            self.append(container)
+            self.add_index(container, container.uuid, container.get('disk', None))
+
+            for store in container.physical_stores:
+                self.add_index(store, store.uuid, store.get('disk', None))
+
+            for volume in container.volumes:
+                self.add_index(volume, volume.uuid, volume.get('disk', None))
+                for snapshot in volume.snapshots:
+                    self.add_index(snapshot, snapshot.uuid)
+
+    @property
+    def volumes(self):
+        return [volume for container in self for volume in container.volumes]
+
+
+class APFSItem(dict):
+    """
+    Common base class for APFS items
+    """
+    label = 'Item'
+    uuid_key = None
+    plist_map = {}
+
+    def __init__(self, data):
+        self.uuid = data.get(self.uuid_key, None)
+        for key, value in data.items():
+            if key in PLIST_STRUCTURE_KEYS:
+                continue
+            self[self.plist_map.get(key, key)] = value
+
+    def __str__(self):
+        return '{0} {1}\n{2}'.format(
+            self.label,
+            self.uuid,
+            '\n'.join('{0:20} {1}'.format(k, v) for k, v in self.items())
+        )
+
+
+class APFSContainer(APFSItem):
+    """
+    APFS container
+    """
+    label = 'Container'
+    uuid_key = 'APFSContainerUUID'
+    plist_map = CONTAINER_PLIST_MAP
+
+    def __init__(self, data):
+        super(APFSContainer, self).__init__(data)
+        self.physical_stores = [APFSPhysicalStore(self, store) for store in data.get('PhysicalStores', [])]
+        self.volumes = [APFSVolume(self, volume) for volume in data.get('Volumes', [])]
+
+
+class APFSPhysicalStore(APFSItem):
+    """
+    Physical store disk of an APFS container
+    """
+    label = 'Physical Store'
+    uuid_key = 'DiskUUID'
+    plist_map = PHYSICAL_STORE_PLIST_MAP
+
+    def __init__(self, container, data):
+        super(APFSPhysicalStore, self).__init__(data)
+        self.container = container
+
+
+class APFSVolume(APFSItem):
+    """
+    APFS volume in a container
+    """
+    label = 'Volume'
+    uuid_key = 'APFSVolumeUUID'
+    plist_map = VOLUME_PLIST_MAP
+
+    def __init__(self, container, data):
+        super(APFSVolume, self).__init__(data)
+        self.container = container
+        self.snapshots = [APFSSnapshot(self, snapshot) for snapshot in data.get('Snapshots', [])]
+
+
+class APFSSnapshot(APFSItem):
+    """
+    Snapshot of an APFS volume
+    """
+    label = 'Snapshot'
+    uuid_key = 'SnapshotUUID'
+    plist_map = SNAPSHOT_PLIST_MAP
+
+    def __init__(self, volume, data):
+        super(APFSSnapshot, self).__init__(data)
+        self.volume = volume
+
+
+class StorageLayout(object):
+    """
+    APFS and CoreStorage layout of the host
+
+    Lookups check APFS items first and then CoreStorage items. A layout
+    type not supported by the host is left as None.
+    """
+    def __init__(self):
+        self.apfs = None
+        self.corestorage = None
+        self.update()
+
+    def __str__(self):
+        return 'APFS {0} CoreStorage {1}'.format(self.apfs, self.corestorage)
+
+    def update(self):
+        """
+        Load APFS and CoreStorage details
+        """
+        try:
+            self.apfs = APFSContainers()
+        except APFSError:
+            self.apfs = None
+
+        try:
+            self.corestorage = coreStorage()
+        except ValueError:
+            self.corestorage = None
+
+    @property
+    def indexes(self):
+        return [index for index in (self.apfs, self.corestorage) if index is not None]
+
+    def find_uuid(self, uuid):
+        """
+        Return APFS or CoreStorage item matching UUID or None
+        """
+        for index in self.indexes:
+            item = index.find_uuid(uuid)
+            if item is not None:
+                return item
+        return None
+
+    def find_device(self, device):
+        """
+        Return APFS or CoreStorage item for disk device or None
+        """
+        for index in self.indexes:
+            item = index.find_device(device)
+            if item is not None:
+                return item
+        return None
+
+    def lookup(self, value):
+        """
+        Return APFS or CoreStorage item matching UUID or disk device or None
+        """
+        for index in self.indexes:
+            item = index.lookup(value)
+            if item is not None:
+                return item
+        return None
@@ -2,9 +2,15 @@
 OS/X application bundles
 """
 
+import json
 import os
 import plistlib
+import re
+import tempfile
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE
 from xml.parsers.expat import ExpatError
 
 INFO_BUNDLE_NAME_MAP = {
@@ -14,19 +20,96 @@ INFO_BUNDLE_NAME_MAP = {
     'short_version':    'CFBundleShortVersionString',
 }
 
+DEFAULT_JOBS = 8
+
+# Application roots for a full host inventory
+DEFAULT_INVENTORY_ROOTS = (
+    '/Applications',
+    os.path.expanduser('~/Applications'),
+    '/System/Applications',
+    '/Library/Application Support',
+)
+
+# Fields exported for each bundle ID in JSON Lines inventories
+INVENTORY_FIELDS = (
+    'bundle_id',
+    'name',
+    'version',
+    'short_version',
+)
+
+RE_VERSION_SEPARATOR = re.compile(r'[^0-9A-Za-z]+|(?<=[0-9])(?=[A-Za-z])|(?<=[A-Za-z])(?=[0-9])')
+
+MDFIND_COMMAND = '/usr/bin/mdfind'
+SPOTLIGHT_APPLICATION_QUERY = 'kMDItemContentType == com.apple.application-bundle'
+
+# Unit of st_blocks in os.stat results
+STAT_BLOCK_SIZE = 512
+
+DEFAULT_INVENTORY_CACHE_PATH = os.path.expanduser('~/Library/Caches/darwinist/applications.json')
+INVENTORY_CACHE_VERSION = 1
+
 
 class ApplicationError(Exception):
     pass
 
 
+def bundle_disk_usage(path):
+    """
+    Return allocated size of directory tree in bytes
+
+    Allocated blocks of all files and directories are summed without
+    following symlinks. Files with multiple hard links are counted once.
+    """
+    total = 0
+    inodes = set()
+    directories = [path]
+
+    try:
+        st = os.lstat(path)
+    except OSError:
+        raise ApplicationError('No such directory: {0}'.format(path))
+    total += st.st_blocks * STAT_BLOCK_SIZE
+
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError:
+            continue
+
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if st.st_nlink > 1 and not entry.is_dir(follow_symlinks=False):
+                if (st.st_dev, st.st_ino) in inodes:
+                    continue
+                inodes.add((st.st_dev, st.st_ino))
+
+            total += st.st_blocks * STAT_BLOCK_SIZE
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+
+    return total
+
+
 class Application(object):
     """
     Class to parse OS/X application bundle (.app) directory
+
+    With validate=False the path is not checked, for callers which have
+    already checked it is an application bundle directory.
     """
 
-    def __init__(self, path):
+    def __init__(self, path, validate=True):
         self.path = path
         self.__cached_info = None
+        self.__cached_size = None
+
+        if not validate:
+            return
 
         if not os.path.isdir(path):
             raise ApplicationError('No such directory: {0}'.format(self.path))
@@ -39,10 +122,27 @@ class Application(object):
 
     @property
     def info(self):
-        if not self.__cached_info:
+        if self.__cached_info is None:
             self.__cached_info = ApplicationInfo(self)
         return self.__cached_info
 
+    @info.setter
+    def info(self, value):
+        self.__cached_info = value
+
+    @property
+    def size(self):
+        """
+        Allocated size of the bundle in bytes
+        """
+        if self.__cached_size is None:
+            self.__cached_size = bundle_disk_usage(os.path.realpath(self.path))
+        return self.__cached_size
+
+    @size.setter
+    def size(self, value):
+        self.__cached_size = value
+
     @property
     def version(self):
         info = self.info
@@ -58,19 +158,92 @@ class Application(object):
 class ApplicationInfo(dict):
     """
     Information for an application, as dictionary
+
+    Info.plist is parsed with plistlib.load, supporting both binary and XML
+    plists. Unless lazy is False, only the known keys are kept after
+    parsing, to save memory when listing many bundles. Known keys default
+    to the INFO_BUNDLE_NAME_MAP keys. The whole dictionary is loaded when
+    any other key is used or the dictionary is iterated.
+
+    If details are given, for example from ApplicationInventoryCache, they
+    are used for the known keys without parsing Info.plist.
     """
 
-    def __init__(self, application):
+    def __init__(self, application, details=None, keys=None, lazy=True):
         self.path = os.path.join(application.path, 'Contents', 'Info.plist')
+        self.__complete__ = False
+        self.__known_keys__ = frozenset(keys is not None and keys or INFO_BUNDLE_NAME_MAP.values())
+
+        if details is not None:
+            self.update(details)
+        elif lazy:
+            self.__load__(self.__known_keys__)
+        else:
+            self.__load__()
 
+    def __load__(self, keys=None):
+        """
+        Parse the Info.plist file, keeping only given keys if keys is not None
+        """
         if not os.path.isfile(self.path):
             raise ApplicationError('No such file: {0}'.format(self.path))
 
         try:
-            self.update(plistlib.readPlist(self.path).items())
-        except ExpatError as e:
+            with open(self.path, 'rb') as fd:
+                data = plistlib.load(fd)
+        except (ExpatError, ValueError) as e:
             raise ApplicationError('Error parsing {0}: {1}'.format(self.path, e))
 
+        if keys is None:
+            self.update(data)
+            self.__complete__ = True
+        else:
+            for key in keys:
+                if key in data:
+                    self[key] = data[key]
+
+    def __load_complete__(self):
+        if not self.__complete__:
+            self.__load__()
+
+    def __missing__(self, key):
+        if not self.__complete__ and key not in self.__known_keys__:
+            self.__load__()
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key) and not self.__complete__ and key not in self.__known_keys__:
+            self.__load__()
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self.__load_complete__()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.__load_complete__()
+        return dict.__len__(self)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        self.__load_complete__()
+        return dict.keys(self)
+
+    def items(self):
+        self.__load_complete__()
+        return dict.items(self)
+
+    def values(self):
+        self.__load_complete__()
+        return dict.values(self)
+
     def __repr__(self):
         return str('{0} {1}'.format(self.name, self.version))
 
@@ -84,42 +257,531 @@ class ApplicationInfo(dict):
             return None
 
 
-class ApplicationTree(list):
+class ApplicationInventoryCache(dict):
     """
-    Tree of OS/X applications (.app directory bundles)
+    Persistent cache of parsed application details by bundle path
+
+    Entries store the INFO_BUNDLE_NAME_MAP keys of the Info.plist file with
+    its mtime, size and inode. Info.plist is parsed again only when these
+    change. Bundle disk usage is stored in the same entries and computed
+    again when the fingerprint or the bundle Contents directory mtime
+    changes.
     """
 
-    def __init__(self, path='/Applications', max_depth=2):
+    def __init__(self, path=DEFAULT_INVENTORY_CACHE_PATH):
         self.path = path
+        self.lock = threading.Lock()
+
+        # Unreadable, corrupt or partially written cache is ignored and rebuilt
+        try:
+            with open(self.path, 'r') as fd:
+                data = json.load(fd)
+        except (IOError, OSError, ValueError):
+            return
+
+        if not isinstance(data, dict) or data.get('version', None) != INVENTORY_CACHE_VERSION:
+            return
+
+        applications = data.get('applications', None)
+        if not isinstance(applications, dict):
+            return
+
+        for path, entry in applications.items():
+            if isinstance(entry, dict) and 'fingerprint' in entry and isinstance(entry.get('info', None), dict):
+                self[path] = entry
+
+    def save(self):
+        """
+        Write cache to file
+
+        Data is written to a temporary file in the same directory, which is
+        then renamed over the cache file.
+        """
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, temporary = tempfile.mkstemp(dir=directory or None, prefix='.applications.', suffix='.tmp')
+        except (IOError, OSError) as e:
+            raise ApplicationError('Error writing {0}: {1}'.format(self.path, e))
+
+        try:
+            with os.fdopen(fd, 'w') as fd:
+                json.dump({'version': INVENTORY_CACHE_VERSION, 'applications': self}, fd)
+            os.replace(temporary, self.path)
+        except (IOError, OSError) as e:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            raise ApplicationError('Error writing {0}: {1}'.format(self.path, e))
+
+    def __fingerprint__(self, application):
+        path = os.path.join(application.path, 'Contents', 'Info.plist')
+        try:
+            st = os.stat(path)
+        except OSError:
+            raise ApplicationError('No such file: {0}'.format(path))
+        return [st.st_mtime_ns, st.st_size, st.st_ino]
+
+    def load_info(self, application):
+        """
+        Return ApplicationInfo for application, from cache if Info.plist is unchanged
+        """
+        fingerprint = self.__fingerprint__(application)
+
+        entry = self.get(application.path, None)
+        if entry is not None and entry['fingerprint'] == fingerprint:
+            return ApplicationInfo(application, entry['info'])
+
+        info = ApplicationInfo(application)
+        details = dict(
+            (key, info.get(key)) for key in INFO_BUNDLE_NAME_MAP.values()
+            if isinstance(info.get(key), (str, int, float, bool))
+        )
+        with self.lock:
+            self[application.path] = {'fingerprint': fingerprint, 'info': details}
+        return info
+
+    def load_size(self, application):
+        """
+        Return allocated size of application, from cache if bundle is unchanged
+        """
+        self.load_info(application)
+        try:
+            contents_mtime = os.stat(os.path.join(application.path, 'Contents')).st_mtime_ns
+        except OSError:
+            raise ApplicationError('No such directory: {0}'.format(application.path))
+
+        entry = self[application.path]
+        if entry.get('size', None) is not None and entry.get('contents_mtime', None) == contents_mtime:
+            return entry['size']
+
+        size = application.size
+        with self.lock:
+            entry['size'] = size
+            entry['contents_mtime'] = contents_mtime
+        return size
+
+    def prune(self, root, paths):
+        """
+        Remove entries under root which are not in paths
+        """
+        prefix = root.rstrip(os.sep) + os.sep
+        paths = set(paths)
+        for path in [path for path in self.keys() if path.startswith(prefix)]:
+            if path not in paths:
+                del self[path]
+
+
+class SpotlightDiscovery(object):
+    """
+    Application bundle discovery with Spotlight
+
+    Bundle paths are read from mdfind output as it is produced. The command
+    can be replaced with any command taking the same arguments, for example
+    a local stand-in for testing. Applications inside other application
+    bundles are skipped unless include_nested is set.
+    """
+
+    def __init__(self, command=MDFIND_COMMAND, include_nested=False):
+        self.command = command
+        self.include_nested = include_nested
+
+    def paths(self, root):
+        """
+        Generator for application bundle paths under root
+        """
+        cmd = (self.command, '-onlyin', root, SPOTLIGHT_APPLICATION_QUERY)
+        try:
+            p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        except OSError as e:
+            raise ApplicationError('Error running {0}: {1}'.format(' '.join(cmd), e))
+
+        try:
+            for line in p.stdout:
+                path = line.decode('utf-8').rstrip('\n')
+                if not path:
+                    continue
+                if not self.include_nested and '.app' + os.sep in path[len(root):]:
+                    continue
+                yield path
+        finally:
+            p.stdout.close()
+            p.wait()
+
+        if p.returncode != 0:
+            raise ApplicationError('Error running {0}: returned {1}'.format(' '.join(cmd), p.returncode))
+
+
+class ListDiscovery(object):
+    """
+    Application bundle discovery from a fixed list of paths
+
+    Stand-in for SpotlightDiscovery where Spotlight is not available.
+    """
+
+    def __init__(self, paths):
+        self.bundle_paths = paths
+
+    def paths(self, root):
+        prefix = root.rstrip(os.sep) + os.sep
+        for path in self.bundle_paths:
+            if path.startswith(prefix):
+                yield path
+
+
+class ApplicationScanner(object):
+    """
+    Parallel scanner for application bundles in a directory tree
+
+    Directories are listed with os.scandir level by level with a thread
+    pool. Directories reached again with symlinks are detected by device
+    and inode and skipped. Info.plist files of found applications are
+    parsed with the same pool when prefetch_info is set, using cache for
+    unchanged bundles if given.
+
+    If discovery backend like SpotlightDiscovery is given, bundle paths are
+    requested from it first, without depth limit. The directory walk is
+    used if the backend fails or finds no applications, for example when
+    Spotlight indexing is disabled.
+    """
+
+    def __init__(self, max_depth=2, jobs=DEFAULT_JOBS, prefetch_info=True, cache=None, discovery=None):
         self.max_depth = max_depth
-        self.update()
+        self.jobs = jobs
+        self.prefetch_info = prefetch_info
+        self.cache = cache
+        self.discovery = discovery
 
-    def update(self):
+    def __load_info__(self, app):
+        try:
+            if self.cache is not None:
+                app.info = self.cache.load_info(app)
+            else:
+                app.info
+        except ApplicationError:
+            pass
+
+    def scan(self, path):
         """
-        Update application tree recursively with load_tree()
+        Return list of Application objects found under path, sorted by path
         """
+        apps = []
+        if not os.path.isdir(path):
+            return apps
+
+        if self.discovery is not None:
+            try:
+                apps = self.__discover__(path)
+            except ApplicationError:
+                apps = []
+            if apps:
+                return apps
+
+        return self.__walk__(path)
+
+    def __discover__(self, path):
+        """
+        Return applications found by discovery backend, sorted by path
+
+        Info.plist files are parsed while paths are still being read.
+        """
+        apps = []
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+            futures = []
+            for bundle_path in self.discovery.paths(path):
+                try:
+                    app = Application(bundle_path)
+                except ApplicationError:
+                    continue
+                apps.append(app)
+                if self.prefetch_info:
+                    futures.append(executor.submit(self.__load_info__, app))
+
+            for future in futures:
+                future.result()
+
+        apps.sort(key=lambda app: app.path.split(os.sep))
+        return apps
 
-        def load_tree(path, depth=0):
+    def __walk__(self, path):
+        """
+        Return applications found by walking directories, sorted by path
+        """
+        visited = set()
+        lock = threading.Lock()
+
+        def scan_directory(directory):
             """
-            Load tree items from given path
+            Return tuple (applications, subdirectories) for directory
             """
-            if depth >= self.max_depth:
-                return []
+            try:
+                st = os.stat(directory)
+            except OSError:
+                return [], []
+
+            with lock:
+                if (st.st_dev, st.st_ino) in visited:
+                    return [], []
+                visited.add((st.st_dev, st.st_ino))
 
             apps = []
-            for s in sorted(os.path.join(path, d) for d in os.listdir(path)):
-                if not os.path.isdir(s):
+            directories = []
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                return [], []
+
+            for entry in entries:
+                try:
+                    if not entry.is_dir():
+                        continue
+                except OSError:
                     continue
 
-                if os.path.splitext(s)[1][1:] == 'app':
-                    apps.append(Application(s))
+                if os.path.splitext(entry.name)[1] == '.app':
+                    if entry.is_symlink() and os.path.splitext(os.path.realpath(entry.path))[1] != '.app':
+                        continue
+                    apps.append(Application(entry.path, validate=False))
                 else:
-                    apps.extend(load_tree(s, depth=depth+1))
+                    directories.append(entry.path)
 
-            return apps
+            return apps, directories
 
-        if not os.path.isdir(self.path):
-            return
+        apps = []
+        with ThreadPoolExecutor(max_workers=max(self.jobs, 1)) as executor:
+            level = [path]
+            for depth in range(self.max_depth):
+                directories = []
+                for found, subdirectories in executor.map(scan_directory, level):
+                    apps.extend(found)
+                    directories.extend(subdirectories)
+                if not directories:
+                    break
+                level = directories
+
+            apps.sort(key=lambda app: app.path.split(os.sep))
+            if self.prefetch_info:
+                list(executor.map(self.__load_info__, apps))
+
+        return apps
+
+
+def application_sizes(applications, jobs=DEFAULT_JOBS, cache=None):
+    """
+    Return list of (application, size) tuples, largest first
+
+    Bundle sizes are computed with a pool of jobs threads, using cache for
+    unchanged bundles if given. Applications which can't be read are skipped.
+    """
+    def load_size(app):
+        try:
+            if cache is not None:
+                return app, cache.load_size(app)
+            return app, app.size
+        except ApplicationError:
+            return app, None
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        sizes = [item for item in executor.map(load_size, applications) if item[1] is not None]
+
+    sizes.sort(key=lambda item: (-item[1], item[0].path))
+    return sizes
+
+
+def version_key(version):
+    """
+    Return sort key for version string, comparing numeric parts as numbers
+    """
+    if version is None:
+        return ()
+    parts = []
+    for part in RE_VERSION_SEPARATOR.split(str(version)):
+        if part == '':
+            continue
+        if part.isdigit():
+            parts.append((1, int(part), ''))
+        else:
+            parts.append((0, 0, part))
+    return tuple(parts)
+
+
+def read_inventory(path):
+    """
+    Generator for inventory entries from a JSON Lines file
+    """
+    try:
+        with open(path, 'r') as fd:
+            for line in fd:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    except (IOError, OSError, ValueError) as e:
+        raise ApplicationError('Error reading {0}: {1}'.format(path, e))
+
+
+class InventoryDiff(object):
+    """
+    Differences between two application inventories by bundle ID
+
+    Both inventories are read one entry at a time to hash tables with the
+    latest version of each bundle ID, which are then joined. Each list
+    contains tuples (bundle_id, old version, new version), with None for a
+    missing version.
+    """
+
+    def __init__(self, old_entries, new_entries):
+        self.added = []
+        self.removed = []
+        self.upgraded = []
+        self.downgraded = []
+
+        old = {}
+        for bundle_id, version in self.__versions__(old_entries):
+            if bundle_id not in old or version_key(version) > version_key(old[bundle_id]):
+                old[bundle_id] = version
+
+        new = {}
+        for bundle_id, version in self.__versions__(new_entries):
+            if bundle_id not in new or version_key(version) > version_key(new[bundle_id]):
+                new[bundle_id] = version
+
+        for bundle_id, latest in new.items():
+            if bundle_id not in old:
+                self.added.append((bundle_id, None, latest))
+                continue
+
+            previous = old[bundle_id]
+            if version_key(latest) > version_key(previous):
+                self.upgraded.append((bundle_id, previous, latest))
+            elif version_key(latest) < version_key(previous):
+                self.downgraded.append((bundle_id, previous, latest))
 
-        self.__delslice__(0, len(self))
-        self.extend(load_tree(self.path))
+        for bundle_id, previous in old.items():
+            if bundle_id not in new:
+                self.removed.append((bundle_id, previous, None))
+
+        for changes in (self.added, self.removed, self.upgraded, self.downgraded):
+            changes.sort()
+
+    def __repr__(self):
+        return '{0:d} added {1:d} removed {2:d} upgraded {3:d} downgraded'.format(
+            len(self.added), len(self.removed), len(self.upgraded), len(self.downgraded),
+        )
+
+    def __versions__(self, entries):
+        """
+        Generator for (bundle_id, version) tuples of inventory entries with bundle ID
+        """
+        for entry in entries:
+            bundle_id = entry.get('bundle_id', None)
+            if bundle_id is None:
+                continue
+            version = entry.get('version', None)
+            if version is None:
+                version = entry.get('short_version', None)
+            yield bundle_id, version is not None and str(version) or ''
+
+
+class ApplicationTree(list):
+    """
+    Tree of OS/X applications (.app directory bundles)
+
+    Path can be a single root directory or a list of roots, for example
+    DEFAULT_INVENTORY_ROOTS. Applications are indexed by bundle ID and
+    version in bundle_index.
+    """
+
+    def __init__(self, path='/Applications', max_depth=2, jobs=DEFAULT_JOBS, cache=None, discovery=None):
+        if isinstance(path, str):
+            self.paths = [path]
+        else:
+            self.paths = list(path)
+        self.path = self.paths[0]
+        self.bundle_index = {}
+        self.max_depth = max_depth
+        self.jobs = jobs
+        self.cache = cache
+        self.discovery = discovery
+        self.update()
+
+    def update(self):
+        """
+        Update application tree with ApplicationScanner
+
+        If cache is set, removed applications are dropped from it and it is saved.
+        """
+        scanner = ApplicationScanner(
+            max_depth=self.max_depth,
+            jobs=self.jobs,
+            cache=self.cache,
+            discovery=self.discovery,
+        )
+        del self[:]
+        self.bundle_index = {}
+
+        for root in self.paths:
+            if not os.path.isdir(root):
+                continue
+
+            apps = scanner.scan(root)
+            self.extend(apps)
+            if self.cache is not None:
+                self.cache.prune(root, [app.path for app in apps])
+
+        for app in self:
+            try:
+                bundle_id = app.info.bundle_id
+            except ApplicationError:
+                continue
+            if bundle_id is not None:
+                self.bundle_index.setdefault(bundle_id, {}).setdefault(app.version, []).append(app)
+
+        if self.cache is not None:
+            self.cache.save()
+
+    def inventory(self):
+        """
+        Generator for inventory entry dictionaries, one per bundle ID
+
+        Fields are read from the latest version of the bundle ID and paths
+        lists all copies of it. Applications without bundle ID are exported
+        one entry per application.
+        """
+        for bundle_id in sorted(self.bundle_index):
+            versions = self.bundle_index[bundle_id]
+            latest = versions[max(versions, key=version_key)][0]
+            entry = dict((field, getattr(latest.info, field)) for field in INVENTORY_FIELDS)
+            entry['paths'] = sorted(app.path for apps in versions.values() for app in apps)
+            yield entry
+
+        for app in self:
+            try:
+                info = app.info
+                if info.bundle_id is not None:
+                    continue
+            except ApplicationError:
+                continue
+            entry = dict((field, getattr(info, field)) for field in INVENTORY_FIELDS)
+            entry['paths'] = [app.path]
+            yield entry
+
+    def write_inventory(self, fd):
+        """
+        Write inventory as JSON Lines to file object fd, one bundle ID per line
+        """
+        for entry in self.inventory():
+            fd.write(json.dumps(entry, sort_keys=True, default=str))
+            fd.write('\n')
+
+    def sizes(self):
+        """
+        Return list of (application, size) tuples, largest first
+
+        Cache is saved after computing the sizes if it is set.
+        """
+        sizes = application_sizes(self, jobs=self.jobs, cache=self.cache)
+        if self.cache is not None:
+            self.cache.save()
+        return sizes
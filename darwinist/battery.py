@@ -2,7 +2,10 @@
 Wrapper to get OS/X darwin laptop battery status from command line
 """
 
+import time
+
 from darwinist.ioreg import IORegTree
+from darwinist.ringbuffer import RingBuffer
 
 BATTERY_IGNORE_FIELDS = (
     'CellVoltage',
@@ -11,9 +14,20 @@ BATTERY_IGNORE_FIELDS = (
     'ManufacturerData',
 )
 
+
+def signed_int64(value):
+    """
+    Return integer with negative values reported by ioreg as unsigned 64 bit
+    """
+    value = int(value)
+    if value >= 2 ** 63:
+        value -= 2 ** 64
+    return value
+
+
 BATTERY_FIELD_FORMATS = {
     'AdapterInfo': lambda x: int(x),
-    'Amperage': lambda x: int(x),
+    'Amperage': signed_int64,
     'AvgTimeToEmpty': lambda x: int(x),
     'AvgTimeToFull': lambda x: int(x),
     'BatteryInstalled': lambda x: x == 'Yes' and True or False,
@@ -27,7 +41,7 @@ BATTERY_FIELD_FORMATS = {
     'ExternalConnected': lambda x: x == 'Yes' and True or False,
     'FirmwareSerialNumber': lambda x: int(x),
     'FullyCharged': lambda x: x == 'Yes' and True or False,
-    'InstantAmperage': lambda x: int(x),
+    'InstantAmperage': signed_int64,
     'InstantTimeToEmpty': lambda x: int(x),
     'IsCharging': lambda x: x == 'Yes' and True or False,
     'Location': lambda x: int(x),
@@ -42,6 +56,29 @@ BATTERY_FIELD_FORMATS = {
     'Voltage': lambda x: float(x) / 1000,
 }
 
+# Battery fields recorded to ring buffers by BatterySampler
+BATTERY_SAMPLE_FIELDS = (
+    'CurrentCapacity',
+    'Amperage',
+    'Voltage',
+    'Temperature',
+)
+
+# Additional battery fields parsed by BatterySampler for rate and ETA estimation
+BATTERY_SAMPLE_STATE_FIELDS = (
+    'MaxCapacity',
+    'IsCharging',
+    'ExternalConnected',
+)
+
+DEFAULT_SAMPLE_COUNT = 360
+DEFAULT_SAMPLE_INTERVAL = 10
+DEFAULT_RATE_SMOOTHING = 0.2
+
+
+class BatteryError(Exception):
+    pass
+
 
 class Batteries(list):
     """
@@ -116,3 +153,110 @@ class Battery(dict):
 
     def values(self):
         return [self[k] for k in self.keys()]
+
+
+class BatterySampler(object):
+    """
+    Battery telemetry sampler
+
+    Selected battery fields are recorded to fixed size ring buffers, keyed by
+    lower case field name like in Battery. The rate is the exponentially
+    smoothed change of current capacity in mAh per hour, negative when
+    discharging.
+    """
+    def __init__(self, size=DEFAULT_SAMPLE_COUNT, fields=BATTERY_SAMPLE_FIELDS,
+                 smoothing=DEFAULT_RATE_SMOOTHING, index=0):
+        self.fields = fields
+        self.smoothing = smoothing
+        self.index = index
+        self.ioreg_keys = frozenset(fields + BATTERY_SAMPLE_STATE_FIELDS)
+
+        self.timestamps = RingBuffer(size)
+        self.buffers = dict((field.lower(), RingBuffer(size)) for field in fields)
+
+        self.rate = None
+        self.maxcapacity = None
+        self.ischarging = None
+        self.externalconnected = None
+        self.__previous_capacity__ = None
+        self.__previous_timestamp__ = None
+
+    def __repr__(self):
+        return 'BatterySampler {0:d} samples'.format(len(self.timestamps))
+
+    def __getitem__(self, field):
+        return self.buffers[field.lower()]
+
+    def sample(self):
+        """
+        Read battery fields from ioreg and record one sample
+        """
+        groups = IORegTree('AppleSmartBattery', keys=self.ioreg_keys)
+        if len(groups) <= self.index:
+            return None
+
+        details = groups[self.index]
+        timestamp = time.time()
+        self.timestamps.append(timestamp)
+
+        for field in self.fields:
+            try:
+                value = BATTERY_FIELD_FORMATS[field](details[field].value)
+            except KeyError:
+                value = float('nan')
+            self.buffers[field.lower()].append(value)
+
+        for field in BATTERY_SAMPLE_STATE_FIELDS:
+            if field in details:
+                setattr(self, field.lower(), BATTERY_FIELD_FORMATS[field](details[field].value))
+
+        if 'CurrentCapacity' in details:
+            self.__update_rate__(timestamp, BATTERY_FIELD_FORMATS['CurrentCapacity'](details['CurrentCapacity'].value))
+
+        return timestamp
+
+    def __update_rate__(self, timestamp, capacity):
+        """
+        Update smoothed capacity change rate with new capacity value
+        """
+        if self.__previous_timestamp__ is not None and timestamp > self.__previous_timestamp__:
+            rate = (capacity - self.__previous_capacity__) * 3600.0 / (timestamp - self.__previous_timestamp__)
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate = self.smoothing * rate + (1 - self.smoothing) * self.rate
+
+        self.__previous_timestamp__ = timestamp
+        self.__previous_capacity__ = capacity
+
+    @property
+    def eta(self):
+        """
+        Estimated seconds until battery is empty when discharging, or full when charging
+        """
+        if not self.rate or 'currentcapacity' not in self.buffers:
+            return None
+
+        capacity = self.buffers['currentcapacity'].last
+        if self.rate < 0:
+            return int(capacity * 3600 / -self.rate)
+
+        if self.maxcapacity is None:
+            return None
+        return int(max(self.maxcapacity - capacity, 0) * 3600 / self.rate)
+
+    def watch(self, interval=DEFAULT_SAMPLE_INTERVAL, count=None):
+        """
+        Generator to sample battery every interval seconds
+
+        Yields the sampler after each sample. Runs forever unless count is given.
+        Raises BatteryError if the battery is not found.
+        """
+        samples = 0
+        while count is None or samples < count:
+            if samples:
+                time.sleep(interval)
+            if self.sample() is None:
+                raise BatteryError('No battery found')
+            samples += 1
+            yield self
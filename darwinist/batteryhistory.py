@@ -0,0 +1,273 @@
+"""
+Battery health history store
+
+Battery snapshots are appended to a SQLite database. Each sample is also
+added to daily and weekly rollups, so long term capacity degradation can be
+queried without scanning the raw samples. Old raw samples and daily rollups
+are pruned automatically.
+"""
+
+import os
+import sqlite3
+import time
+
+from datetime import datetime, timezone
+
+DEFAULT_HISTORY_PATH = os.path.expanduser('~/Library/Application Support/darwinist/battery-history.sqlite')
+
+# Raw samples and daily rollups older than this many seconds are removed
+RAW_SAMPLE_RETENTION = 86400 * 30
+DAILY_ROLLUP_RETENTION = 86400 * 730
+
+# Rollup period lengths and offsets to align periods to UTC days. Weeks start on monday.
+ROLLUP_PERIODS = {
+    'day':  (86400, 0),
+    'week': (86400 * 7, 86400 * 4),
+}
+
+HISTORY_SCHEMA = (
+    """
+    CREATE TABLE IF NOT EXISTS samples (
+        serial TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        cyclecount INTEGER,
+        maxcapacity INTEGER,
+        designcapacity INTEGER,
+        currentcapacity INTEGER,
+        temperature REAL,
+        PRIMARY KEY (serial, timestamp)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS rollups (
+        period TEXT NOT NULL,
+        serial TEXT NOT NULL,
+        timestamp INTEGER NOT NULL,
+        samples INTEGER NOT NULL,
+        cyclecount INTEGER,
+        designcapacity INTEGER,
+        maxcapacity_sum INTEGER,
+        maxcapacity_min INTEGER,
+        maxcapacity_max INTEGER,
+        temperature_sum REAL,
+        temperature_min REAL,
+        temperature_max REAL,
+        maxcapacity_count INTEGER NOT NULL DEFAULT 0,
+        temperature_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (period, serial, timestamp)
+    )
+    """,
+)
+
+ROLLUP_COLUMNS = (
+    'period',
+    'serial',
+    'timestamp',
+    'samples',
+    'cyclecount',
+    'designcapacity',
+    'maxcapacity_sum',
+    'maxcapacity_min',
+    'maxcapacity_max',
+    'maxcapacity_count',
+    'temperature_sum',
+    'temperature_min',
+    'temperature_max',
+    'temperature_count',
+)
+
+# NULL metrics in a sample leave the existing rollup values unchanged
+ROLLUP_UPSERT = """
+INSERT INTO rollups ({0}) VALUES (?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (period, serial, timestamp) DO UPDATE SET
+    samples = samples + 1,
+    cyclecount = max(coalesce(cyclecount, excluded.cyclecount), coalesce(excluded.cyclecount, cyclecount)),
+    designcapacity = coalesce(excluded.designcapacity, designcapacity),
+    maxcapacity_sum = coalesce(maxcapacity_sum, 0) + coalesce(excluded.maxcapacity_sum, 0),
+    maxcapacity_min = min(coalesce(maxcapacity_min, excluded.maxcapacity_min),
+                          coalesce(excluded.maxcapacity_min, maxcapacity_min)),
+    maxcapacity_max = max(coalesce(maxcapacity_max, excluded.maxcapacity_max),
+                          coalesce(excluded.maxcapacity_max, maxcapacity_max)),
+    maxcapacity_count = maxcapacity_count + excluded.maxcapacity_count,
+    temperature_sum = coalesce(temperature_sum, 0) + coalesce(excluded.temperature_sum, 0),
+    temperature_min = min(coalesce(temperature_min, excluded.temperature_min),
+                          coalesce(excluded.temperature_min, temperature_min)),
+    temperature_max = max(coalesce(temperature_max, excluded.temperature_max),
+                          coalesce(excluded.temperature_max, temperature_max)),
+    temperature_count = temperature_count + excluded.temperature_count
+""".format(', '.join(ROLLUP_COLUMNS))
+
+
+class BatteryHistoryError(Exception):
+    pass
+
+
+class BatteryRollup(dict):
+    """
+    Aggregated battery details for one rollup period
+
+    Periods are aligned to UTC, so date is a UTC datetime.
+    """
+    def __init__(self, row):
+        (period, serial, timestamp, samples, cyclecount, designcapacity,
+         maxcapacity_sum, maxcapacity_min, maxcapacity_max, maxcapacity_count,
+         temperature_sum, temperature_min, temperature_max, temperature_count) = row
+
+        self.update({
+            'period': period,
+            'serial': serial,
+            'timestamp': timestamp,
+            'date': datetime.fromtimestamp(timestamp, timezone.utc),
+            'samples': samples,
+            'cyclecount': cyclecount,
+            'designcapacity': designcapacity,
+            'maxcapacity': maxcapacity_count and float(maxcapacity_sum) / maxcapacity_count or None,
+            'maxcapacity_min': maxcapacity_min,
+            'maxcapacity_max': maxcapacity_max,
+            'temperature': temperature_count and float(temperature_sum) / temperature_count or None,
+            'temperature_min': temperature_min,
+            'temperature_max': temperature_max,
+        })
+
+        if designcapacity and self['maxcapacity'] is not None:
+            self['health'] = self['maxcapacity'] / designcapacity * 100
+        else:
+            self['health'] = None
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError('No such BatteryRollup attribute: {0}'.format(attr))
+
+    def __repr__(self):
+        return '{0} {1} {2}/{3} mAh {4} cycles'.format(
+            self.date.strftime('%Y-%m-%d'),
+            self.period,
+            self.maxcapacity is not None and '{0:.0f}'.format(self.maxcapacity) or '-',
+            self.designcapacity,
+            self.cyclecount,
+        )
+
+
+class BatteryHistory(object):
+    """
+    Append only battery health history database
+    """
+    def __init__(self, path=DEFAULT_HISTORY_PATH):
+        self.path = path
+        self.__connection__ = None
+
+    @property
+    def connection(self):
+        if self.__connection__ is not None:
+            return self.__connection__
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                raise BatteryHistoryError('Error creating directory {0}: {1}'.format(directory, e))
+
+        try:
+            self.__connection__ = sqlite3.Connection(self.path)
+            for statement in HISTORY_SCHEMA:
+                self.__connection__.execute(statement)
+        except sqlite3.Error as e:
+            raise BatteryHistoryError('Error opening {0}: {1}'.format(self.path, e))
+
+        return self.__connection__
+
+    def close(self):
+        if self.__connection__ is not None:
+            self.__connection__.close()
+            self.__connection__ = None
+
+    def append(self, battery, timestamp=None):
+        """
+        Append a Battery snapshot to history and update rollups
+
+        A sample with existing serial and timestamp replaces the stored
+        sample without updating rollups again.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        timestamp = int(timestamp)
+
+        serial = battery.get('batteryserialnumber', 'UNKNOWN')
+        cyclecount = battery.get('cyclecount', None)
+        maxcapacity = battery.get('maxcapacity', None)
+        designcapacity = battery.get('designcapacity', None)
+        temperature = battery.get('temperature', None)
+
+        with self.connection as c:
+            existing = c.execute(
+                'SELECT 1 FROM samples WHERE serial = ? AND timestamp = ?',
+                (serial, timestamp)
+            ).fetchone()
+            c.execute(
+                'INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (serial, timestamp, cyclecount, maxcapacity, designcapacity,
+                 battery.get('currentcapacity', None), temperature)
+            )
+            if existing is None:
+                for period, (length, offset) in ROLLUP_PERIODS.items():
+                    c.execute(ROLLUP_UPSERT, (
+                        period, serial, timestamp - (timestamp - offset) % length,
+                        cyclecount, designcapacity,
+                        maxcapacity, maxcapacity, maxcapacity, maxcapacity is not None and 1 or 0,
+                        temperature, temperature, temperature, temperature is not None and 1 or 0,
+                    ))
+
+        self.downsample(now=timestamp)
+
+    def downsample(self, now=None):
+        """
+        Remove raw samples and daily rollups past their retention
+
+        Data for removed rows remains available in the coarser rollups.
+        """
+        if now is None:
+            now = time.time()
+        now = int(now)
+
+        with self.connection as c:
+            c.execute('DELETE FROM samples WHERE timestamp < ?', (now - RAW_SAMPLE_RETENTION,))
+            c.execute(
+                'DELETE FROM rollups WHERE period = ? AND timestamp < ?',
+                ('day', now - DAILY_ROLLUP_RETENTION)
+            )
+
+    def samples(self, start=None, end=None, serial=None):
+        """
+        Return raw samples in given time range as list of tuples
+        """
+        query, params = self.__range_query__('SELECT * FROM samples WHERE 1 = 1', start, end, serial)
+        return self.connection.execute(query + ' ORDER BY timestamp', params).fetchall()
+
+    def rollups(self, period='day', start=None, end=None, serial=None):
+        """
+        Return BatteryRollup items for given period and time range
+        """
+        if period not in ROLLUP_PERIODS:
+            raise BatteryHistoryError('Invalid rollup period: {0}'.format(period))
+
+        query, params = self.__range_query__(
+            'SELECT {0} FROM rollups WHERE period = ?'.format(', '.join(ROLLUP_COLUMNS)), start, end, serial
+        )
+        rows = self.connection.execute(query + ' ORDER BY serial, timestamp', [period] + params)
+        return [BatteryRollup(row) for row in rows]
+
+    def __range_query__(self, query, start, end, serial):
+        params = []
+        if serial is not None:
+            query += ' AND serial = ?'
+            params.append(serial)
+        if start is not None:
+            query += ' AND timestamp >= ?'
+            params.append(int(start))
+        if end is not None:
+            query += ' AND timestamp < ?'
+            params.append(int(end))
+        return query, params
@@ -3,10 +3,16 @@ coreStorage status classes:
 
 just a wrapper to parse output from the command line commands to
 dictionaries, grouping the hierarchy for easy consumption.
+
+By default the hierarchy is read from 'diskutil coreStorage list -plist',
+which only lists roles and UUIDs, and details of each item from
+'diskutil coreStorage info -plist'. Items are indexed by UUID and disk
+device for direct lookups.
 """
 
 from builtins import int
 
+import plistlib
 import re
 from subprocess import check_output, CalledProcessError
 
@@ -16,10 +22,19 @@ re_pv_header = re.compile('^Physical Volume ([A-Z0-9-]+)$')
 re_lvf_header = re.compile('^Logical Volume Family ([A-Z0-9-]+)$')
 re_lv_header = re.compile('^Logical Volume ([A-Z0-9-]+)$')
 
-re_size = re.compile('^(\d+) B \(([\d.]+) GB\)$')
+re_size = re.compile(r'^(\d+) B\b')
+
+SIZE_FIELDS = (
+    'size',
+    'free_space',
+    'size_total',
+    'size_converted',
+)
 
 LVG_HEADER_MAP = {
     'Name':                     'name',
+    'Status':                   'status',
+    'Size':                     'size',
     'Free Space':               'free_space',
     'Sequence':                 'sequence',
 }
@@ -28,7 +43,7 @@ PV_HEADER_MAP = {
     'Status':                   'status',
     'Index':                    'index',
     'Disk':                     'disk',
-    'Size':                     'Size',
+    'Size':                     'size',
 }
 
 LVFAMILY_HEADER_MAP = {
@@ -53,14 +68,122 @@ LV_HEADER_MAP = {
     'Revertible':           'revertible',
 }
 
+LVG_PLIST_MAP = {
+    'CoreStorageLogicalVolumeGroupName':            'name',
+    'CoreStorageLogicalVolumeGroupStatus':          'status',
+    'CoreStorageLogicalVolumeGroupSize':            'size',
+    'CoreStorageLogicalVolumeGroupFreeSpace':       'free_space',
+    'CoreStorageLogicalVolumeGroupSequence':        'sequence',
+}
+
+PV_PLIST_MAP = {
+    'CoreStoragePhysicalVolumeStatus':              'status',
+    'CoreStoragePhysicalVolumeIndex':               'index',
+    'CoreStoragePhysicalVolumeSize':                'size',
+    'DeviceIdentifier':                             'disk',
+}
+
+LVFAMILY_PLIST_MAP = {
+    'CoreStorageLogicalVolumeFamilyEncryptionStatus':   'encryption_status',
+    'CoreStorageLogicalVolumeFamilyEncryptionContext':  'encryption_content',
+    'CoreStorageLogicalVolumeFamilyConversionStatus':   'conversion_status',
+    'CoreStorageLogicalVolumeFamilySequence':           'sequence',
+    'CoreStorageLogicalVolumeFamilyEncryptedExtents':   'encrypted',
+    'CoreStorageLogicalVolumeFamilyConversionDirection': 'conversion_direction',
+    'CoreStorageLogicalVolumeFamilyEncryptionType':     'encryption_type',
+}
+
+LV_PLIST_MAP = {
+    'CoreStorageLogicalVolumeStatus':               'status',
+    'CoreStorageLogicalVolumeSequence':             'sequence',
+    'CoreStorageLogicalVolumeConvertedSize':        'size_converted',
+    'CoreStorageLogicalVolumeSize':                 'size_total',
+    'CoreStorageLogicalVolumeVolumeName':           'volume_name',
+    'CoreStorageLogicalVolumeName':                 'lv_name',
+    'CoreStorageLogicalVolumeContentHint':          'content_hint',
+    'CoreStorageLogicalVolumeRevertible':           'revertible',
+    'DeviceIdentifier':                             'disk',
+}
+
+# Plist keys handled by the hierarchy parser, not copied to item details
+PLIST_STRUCTURE_KEYS = (
+    'CoreStorageRole',
+    'CoreStorageUUID',
+    'CoreStoragePhysicalVolumes',
+    'CoreStorageLogicalVolumeFamilies',
+    'CoreStorageLogicalVolumes',
+    'MemberOfCoreStorageLogicalVolumeGroup',
+    'MemberOfCoreStorageLogicalVolumeFamily',
+)
+
+# Fields which must be found for physical and logical volumes. If missing
+# from plist info output, they are read from the text output.
+REQUIRED_PV_FIELDS = ('disk', 'size')
+REQUIRED_LV_FIELDS = ('disk', 'size_total')
+
+
+def device_identifier(value):
+    """
+    Return bare disk identifier (disk1s2) for /dev/disk1s2, /dev/rdisk1s2 or disk1s2
+    """
+    if value.startswith('/dev/'):
+        value = value[5:]
+    if value.startswith('rdisk'):
+        value = value[1:]
+    return value
+
+
+class StorageIndex(object):
+    """
+    Index of storage layout items by UUID and disk device
+    """
+    def reset_index(self):
+        self.uuids = {}
+        self.devices = {}
+
+    def add_index(self, item, uuid=None, device=None):
+        """
+        Add item to index with given UUID and device
+        """
+        if uuid:
+            self.uuids[uuid.upper()] = item
+        if device:
+            self.devices[device_identifier(device)] = item
+
+    def find_uuid(self, uuid):
+        """
+        Return item matching UUID or None
+        """
+        return self.uuids.get(uuid.upper(), None)
+
+    def find_device(self, device):
+        """
+        Return item for device node (/dev/disk1) or identifier (disk1) or None
+        """
+        return self.devices.get(device_identifier(device), None)
+
+    def lookup(self, value):
+        """
+        Return item matching UUID or disk device or None
+        """
+        item = self.find_device(value)
+        if item is None:
+            item = self.find_uuid(value)
+        return item
+
 
-class coreStorage(list):
+class coreStorage(list, StorageIndex):
     """
     Class for OS/X corestorage LVM implementation status parsing
+
+    With plist=False the human readable 'diskutil coreStorage list' output
+    is parsed instead of plist output.
     """
 
-    def __init__(self):
+    def __init__(self, plist=True):
+        self.plist = plist
         self.lvg_count = 0
+        self.reset_index()
         self.update()
 
     def __str__(self):
@@ -70,6 +193,106 @@ class coreStorage(list):
         """
         Parse output of diskutil corestorage list to update data
         """
+        del self[:]
+        if self.plist:
+            self.__update_plist__()
+        else:
+            self.__update_text__()
+        self.__update_index__()
+
+    def __update_index__(self):
+        """
+        Index all groups, volumes and families by UUID and disk
+        """
+        self.reset_index()
+        for lvg in self:
+            self.add_index(lvg, lvg.uuid)
+            for pv in lvg.pvs:
+                self.add_index(pv, pv.uuid, pv.get('disk', None))
+            for lvf in lvg.lvfs:
+                self.add_index(lvf, lvf.uuid)
+                for lv in lvf.lvs:
+                    self.add_index(lv, lv.uuid, lv.get('disk', None))
+
+    def __update_plist__(self):
+        """
+        Parse output of diskutil coreStorage list -plist
+        """
+        cmd = ('diskutil', 'coreStorage', 'list', '-plist')
+        try:
+            data = plistlib.loads(check_output(cmd))
+        except CalledProcessError as e:
+            raise ValueError('Error listing corestorage volumes: {0}'.format(e))
+        except Exception as e:
+            raise ValueError('Error parsing corestorage plist: {0}'.format(e))
+
+        for lvg_data in data.get('CoreStorageLogicalVolumeGroups', []):
+            lvg = coreStorageLVG(lvg_data['CoreStorageUUID'])
+            lvg.update_plist(lvg_data)
+            self.__update_info__(lvg)
+            self.append(lvg)
+
+            for pv_data in lvg_data.get('CoreStoragePhysicalVolumes', []):
+                pv = coreStoragePV(lvg, pv_data['CoreStorageUUID'])
+                pv.update_plist(pv_data)
+                self.__update_info__(pv)
+                lvg.pvs.append(pv)
+
+            for lvf_data in lvg_data.get('CoreStorageLogicalVolumeFamilies', []):
+                lvf = coreStorageLVFamily(lvg, lvf_data['CoreStorageUUID'])
+                lvf.update_plist(lvf_data)
+                self.__update_info__(lvf)
+                lvg.lvfs.append(lvf)
+
+                for lv_data in lvf_data.get('CoreStorageLogicalVolumes', []):
+                    lv = coreStorageLV(lvf, lv_data['CoreStorageUUID'])
+                    lv.update_plist(lv_data)
+                    self.__update_info__(lv)
+                    lvf.lvs.append(lv)
+
+        self.lvg_count = len(self)
+        self.__update_missing__()
+
+    def __update_info__(self, item):
+        """
+        Update item details from diskutil coreStorage info -plist
+        """
+        cmd = ('diskutil', 'coreStorage', 'info', '-plist', item.uuid)
+        try:
+            item.update_plist(plistlib.loads(check_output(cmd)))
+        except CalledProcessError:
+            pass
+        except Exception as e:
+            raise ValueError('Error parsing corestorage info plist: {0}'.format(e))
+
+    def __update_missing__(self):
+        """
+        Fill required volume fields missing from plist output from text output
+        """
+        missing = False
+        for lvg in self:
+            for pv in lvg.pvs:
+                missing |= any(field not in pv for field in REQUIRED_PV_FIELDS)
+            for lvf in lvg.lvfs:
+                for lv in lvf.lvs:
+                    missing |= any(field not in lv for field in REQUIRED_LV_FIELDS)
+        if not missing:
+            return
+
+        text = coreStorage(plist=False)
+        for lvg in self:
+            for item in lvg.pvs + [lv for lvf in lvg.lvfs for lv in lvf.lvs]:
+                details = text.find_uuid(item.uuid)
+                if details is None:
+                    continue
+                for key, value in details.items():
+                    if key not in item:
+                        item[key] = value
+
+    def __update_text__(self):
+        """
+        Parse output of diskutil coreStorage list
+        """
         lvg = None
         pv = None
         lvf = None
@@ -114,11 +337,12 @@ class coreStorage(list):
 
                 m = re_lv_header.match(line)
                 if m:
-                    lv = coreStorageLV(lvg, m.group(1))
+                    lv = coreStorageLV(lvf, m.group(1))
                     lvf.lvs.append(lv)
                     continue
                 try:
                     key, value = line.strip().split(':', 1)
+                    value = value.strip()
                 except ValueError:
                     continue
 
@@ -137,97 +361,99 @@ class coreStorage(list):
             raise ValueError('Error listing corestorege volumes: {0}'.format(e))
 
 
-class coreStorageLVG(dict):
+class coreStorageItem(dict):
     """
-    Class to represent one corestorage LVG (logical volume group)
+    Common base class for corestorage items
+
+    Keys are mapped with header_map from text output and plist_map from plist
+    output. Size fields are stored as integer bytes.
     """
+    label = 'Item'
+    header_map = {}
+    plist_map = {}
+
     def __init__(self, uuid):
         self.uuid = uuid
-        self.pvs = []
-        self.lvfs = []
 
     def __str__(self):
-        return 'LVG {0}\n{1}'.format(
+        return '{0} {1}\n{2}'.format(
+            self.label,
             self.uuid,
             '\n'.join('{0:20} {1}'.format(k, v) for k, v in self.items())
         )
 
     def __setitem__(self, item, value):
         try:
-            item = LVG_HEADER_MAP[item]
+            item = self.header_map[item]
         except KeyError:
             pass
-        super(coreStorageLVG, self).__setitem__(item, value)
+
+        if item in SIZE_FIELDS and not isinstance(value, int):
+            m = re_size.match(str(value))
+            if m:
+                value = int(m.group(1))
+
+        super(coreStorageItem, self).__setitem__(item, value)
+
+    def update_plist(self, data):
+        """
+        Update details from plist dictionary
+        """
+        for key, value in data.items():
+            if key in PLIST_STRUCTURE_KEYS:
+                continue
+            self[self.plist_map.get(key, key)] = value
 
 
-class coreStoragePV(dict):
+class coreStorageLVG(coreStorageItem):
+    """
+    Class to represent one corestorage LVG (logical volume group)
+    """
+    label = 'LVG'
+    header_map = LVG_HEADER_MAP
+    plist_map = LVG_PLIST_MAP
+
+    def __init__(self, uuid):
+        super(coreStorageLVG, self).__init__(uuid)
+        self.pvs = []
+        self.lvfs = []
+
+
+class coreStoragePV(coreStorageItem):
     """
     Class to represent one corestorage PV (physical volume)
     """
+    label = 'PV'
+    header_map = PV_HEADER_MAP
+    plist_map = PV_PLIST_MAP
+
     def __init__(self, lvg, uuid):
+        super(coreStoragePV, self).__init__(uuid)
         self.lvg = lvg
-        self.uuid = uuid
-
-    def __str__(self):
-        return 'PV {0}\n{1}'.format(
-            self.uuid,
-            '\n'.join('{0:20} {1}'.format(k, v) for k, v in self.items())
-        )
-
-    def __setitem__(self, item, value):
-        try:
-            item = PV_HEADER_MAP[item]
-        except KeyError:
-            pass
-        super(coreStoragePV, self).__setitem__(item, value)
 
 
-class coreStorageLVFamily(dict):
+class coreStorageLVFamily(coreStorageItem):
     """
     Core storage LV (Logical Volume) family
     """
+    label = 'LV Family'
+    header_map = LVFAMILY_HEADER_MAP
+    plist_map = LVFAMILY_PLIST_MAP
+
     def __init__(self, lvg, uuid):
+        super(coreStorageLVFamily, self).__init__(uuid)
         self.lvg = lvg
-        self.uuid = uuid
         self.lvs = []
 
-    def __str__(self):
-        return 'LV Family {0}\n{1}'.format(
-            self.uuid,
-            '\n'.join('{0:20} {1}'.format(k, v) for k, v in self.items())
-        )
-
-    def __setitem__(self, item, value):
-        try:
-            item = LVFAMILY_HEADER_MAP[item]
-        except KeyError:
-            pass
-        super(coreStorageLVFamily, self).__setitem__(item, value)
 
-
-class coreStorageLV(dict):
+class coreStorageLV(coreStorageItem):
     """
     Core storage LV (logical volume)
     """
+    label = 'LV'
+    header_map = LV_HEADER_MAP
+    plist_map = LV_PLIST_MAP
+
     def __init__(self, lvf, uuid):
+        super(coreStorageLV, self).__init__(uuid)
         self.lvf = lvf
-        self.uuid = uuid
-
-    def __str__(self):
-        return 'LV {0}\n{1}'.format(
-            self.uuid,
-            '\n'.join('{0:20} {1}'.format(k, v) for k, v in self.items())
-        )
-
-    def __setitem__(self, item, value):
-        try:
-            item = LV_HEADER_MAP[item]
-        except KeyError:
-            pass
-
-        if item in ('size', 'free_space', 'size_total', 'size_converted'):
-            m = re_size.match(value)
-            if m:
-                value = int(m.group(1))
-
-        super(coreStorageLV, self).__setitem__(item, value)
@@ -4,13 +4,20 @@ and detach the configured DMGs.
 """
 
 import os
+import plistlib
+import re
 import sys
+import time
 
-from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, TimeoutExpired
+from xml.parsers.expat import ExpatError
 from configobj import ConfigObj, Section
 
 from systematic.shell import CONFIG_PATH
-from darwinist.diskutil import DiskInfo, DiskUtilError
+from darwinist.diskutil import DiskUtilError, cached_disk_info
+from darwinist.mounts import MountTableCache
+from darwinist.sparsebundle import SparseBundle, SparseBundleError
 
 DEFAULT_CONFIG_PATH = os.path.join(CONFIG_PATH, 'diskimages.conf')
 DEFAULT_VOLUMES = '/Volumes/'
@@ -21,17 +28,154 @@ VALID_CONFIG_ARGS = (
     'args',
 )
 
+DEFAULT_JOBS = 1
+DEFAULT_RETRIES = 3
+DEFAULT_TIMEOUT = 120
+DEFAULT_BACKOFF = 2
+
+# Device node of a whole disk, without slice suffix
+RE_WHOLE_DISK = re.compile(r'^/dev/r?disk[0-9]+$')
+
+
+# Cached attached images, invalidated when the mount table changes
+ATTACHED_IMAGES_CACHE = MountTableCache()
+
 
 class DiskImageError(Exception):
     pass
 
 
+class AttachedImages(dict):
+    """
+    Attached disk images from one 'hdiutil info -plist' call
+
+    Maps real path of each attached image file to the list of attached
+    system entities as dictionaries with 'dev-entry' and 'mount-point' keys.
+    """
+    def __init__(self):
+        cmd = ('hdiutil', 'info', '-plist')
+        p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise DiskImageError('Error running {0}: {1}'.format(' '.join(cmd), stderr))
+
+        try:
+            data = plistlib.loads(stdout)
+        except (ExpatError, ValueError):
+            raise DiskImageError('Error parsing plist: {0}'.format(stdout))
+
+        for image in data.get('images', []):
+            if 'image-path' not in image:
+                continue
+            self[os.path.realpath(image['image-path'])] = image.get('system-entities', [])
+
+    def devices(self, path):
+        """
+        Return attached device nodes for image path
+        """
+        return [e['dev-entry'] for e in self.get(os.path.realpath(path), []) if 'dev-entry' in e]
+
+    def mountpoints(self, path):
+        """
+        Return mount points for image path
+        """
+        return [e['mount-point'] for e in self.get(os.path.realpath(path), []) if 'mount-point' in e]
+
+    def whole_disk(self, path):
+        """
+        Return whole disk device node of image path or None
+
+        APFS images also list the synthesized container disk, so the whole
+        disk with a partition scheme is preferred, then the first whole disk.
+        """
+        disks = [
+            e for e in self.get(os.path.realpath(path), [])
+            if RE_WHOLE_DISK.match(e.get('dev-entry', ''))
+        ]
+        for entity in disks:
+            if entity.get('content-hint', '').endswith('_partition_scheme'):
+                return entity['dev-entry']
+        return disks and disks[0]['dev-entry'] or None
+
+
 class DiskImagesConfig(dict):
     def __init__(self, path=DEFAULT_CONFIG_PATH):
         self.path = path
         if os.path.isfile(path):
             self.read()
 
+    @property
+    def attached_images(self):
+        """
+        AttachedImages for all images, cached until the mount table changes
+        """
+        return ATTACHED_IMAGES_CACHE.lookup('attached', AttachedImages)
+
+    def status(self):
+        """
+        Return status dictionaries for all configured images by name
+
+        Resolved from one hdiutil info call.
+        """
+        return dict((name, dmg.status) for name, dmg in self.items())
+
+    def attach_images(self, images=None, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT,
+                      retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, passphrases=None):
+        """
+        Attach images with a pool of jobs workers
+
+        Returns list of DiskImageResult items in order of images. Passphrases
+        are given as dictionary by image name.
+        """
+        return self.__run_batch__('attach', images, jobs, timeout, retries, backoff, passphrases)
+
+    def detach_images(self, images=None, jobs=DEFAULT_JOBS, timeout=DEFAULT_TIMEOUT,
+                      retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF):
+        """
+        Detach images with a pool of jobs workers
+
+        Returns list of DiskImageResult items in order of images.
+        """
+        return self.__run_batch__('detach', images, jobs, timeout, retries, backoff)
+
+    def __run_batch__(self, action, images, jobs, timeout, retries, backoff, passphrases=None):
+        if images is None:
+            images = self.values()
+        if passphrases is None:
+            passphrases = {}
+
+        # With one job, hdiutil can still prompt on the terminal
+        interactive = jobs <= 1
+
+        def process(dmg):
+            result = DiskImageResult(dmg, action)
+            for attempt in range(1, retries + 1):
+                try:
+                    if dmg.connected == (action == 'attach'):
+                        result.status = attempt == 1 and 'skipped' or 'ok'
+                        return result
+
+                    result.attempts = attempt
+                    if action == 'attach':
+                        dmg.attach(passphrases.get(dmg.name, None), timeout=timeout, interactive=interactive)
+                    else:
+                        dmg.detach(timeout=timeout, interactive=interactive)
+                    result.status = 'ok'
+                    result.error = None
+                    return result
+                except Exception as e:
+                    # Any error is reported per image without aborting the batch
+                    result.status = 'failed'
+                    result.error = e
+
+                if attempt < retries:
+                    time.sleep(backoff * 2 ** (attempt - 1))
+
+            return result
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            return list(executor.map(process, images))
+
     def read(self):
         config = ConfigObj(self.path)
 
@@ -91,45 +235,119 @@ class DiskImage(object):
             ' '.join(self.args),
         )
 
+    @property
+    def status(self):
+        """
+        Attach status for image as dictionary
+        """
+        attached = self.config.attached_images
+        return {
+            'attached': os.path.realpath(self.image) in attached,
+            'devices': attached.devices(self.image),
+            'mountpoints': attached.mountpoints(self.image),
+        }
+
     def __getattr__(self, attr):
         if attr == 'connected':
+            return os.path.realpath(self.image) in self.config.attached_images
+
+        if attr == 'sparsebundle':
+            if os.path.splitext(self.image.rstrip(os.sep))[1] != '.sparsebundle':
+                return None
             try:
-                if 'MountPoint' in self.info:
-                    return True
-                return False
-            except AttributeError:
-                return False
+                return SparseBundle(self.image)
+            except SparseBundleError:
+                return None
 
         if attr == 'info':
             try:
-                return DiskInfo(self.mountpoint)
+                return cached_disk_info(self.mountpoint)
             except DiskUtilError:
                 return {}
 
         raise AttributeError('No such DiskImage attribute: {0}'.format(attr))
 
-    def detach(self):
+    def __hdiutil__(self, cmd, passphrase=None, timeout=None, interactive=True):
+        """
+        Run hdiutil command, killing it after timeout seconds
+
+        If interactive is False, output is captured and stdin is not inherited.
+        Passphrase is written to stdin null terminated, as expected by hdiutil
+        -stdinpass. Returns tuple (returncode, error output).
+        """
+        if isinstance(passphrase, str):
+            passphrase = passphrase.encode('utf-8')
+        if passphrase is not None:
+            passphrase += b'\0'
+
+        if interactive:
+            stdin = passphrase is not None and PIPE or sys.stdin
+            p = Popen(cmd, stdin=stdin, stdout=sys.stdout, stderr=sys.stderr)
+        else:
+            p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+        try:
+            stdout, stderr = p.communicate(passphrase, timeout=timeout)
+        except TimeoutExpired:
+            p.kill()
+            p.communicate()
+            raise DiskImageError('Timeout after {0} seconds: {1}'.format(timeout, ' '.join(cmd)))
+
+        if stderr:
+            stderr = stderr.decode('utf-8', 'replace').strip()
+        return p.returncode, stderr
+
+    def detach(self, timeout=None, interactive=True):
+        """
+        Detach image by its attached device node
+
+        The whole disk device detaches all slices, also for images attached
+        to other mount points or without mounting. Mount point is used if
+        hdiutil reports no whole disk for the image.
+        """
         if not self.connected:
             raise DiskImageError('Not attached: {0}'.format(self.mountpoint))
 
-        cmd = ('hdiutil', 'detach', self.mountpoint)
-        p = Popen(cmd, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
-        p.wait()
-        if p.returncode != 0:
-            raise DiskImageError('Error detaching {0}'.format(self.mountpoint))
+        target = self.config.attached_images.whole_disk(self.image) or self.mountpoint
+        cmd = ('hdiutil', 'detach', target)
+        try:
+            returncode, stderr = self.__hdiutil__(cmd, timeout=timeout, interactive=interactive)
+        finally:
+            ATTACHED_IMAGES_CACHE.clear()
+        if returncode != 0:
+            raise DiskImageError('Error detaching {0}{1}'.format(target, stderr and ': ' + stderr or ''))
 
-    def attach(self, passphrase=None):
+    def attach(self, passphrase=None, timeout=None, interactive=True):
         if self.connected:
             raise DiskImageError('Already attached: {0}'.format(self.mountpoint))
 
         cmd = ['hdiutil', 'attach'] + self.args + [self.image]
+        if passphrase is not None:
+            cmd.insert(2, '-stdinpass')
+        try:
+            returncode, stderr = self.__hdiutil__(cmd, passphrase, timeout=timeout, interactive=interactive)
+        finally:
+            ATTACHED_IMAGES_CACHE.clear()
+        if returncode != 0:
+            raise DiskImageError('Error attaching {0}{1}'.format(self.image, stderr and ': ' + stderr or ''))
+
+
+class DiskImageResult(object):
+    """
+    Result of attaching or detaching one image in a batch
+
+    Status is 'ok', 'skipped' when nothing needed to be done, or 'failed'.
+    """
+    def __init__(self, image, action):
+        self.image = image
+        self.action = action
+        self.status = None
+        self.attempts = 0
+        self.error = None
 
-        if passphrase is None:
-            p = Popen(cmd, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr)
-        else:
-            p = Popen(cmd, stdin=PIPE, stdout=sys.stdout, stderr=sys.stderr)
-            stdout, stderr = p.communicate(passphrase)
-
-        p.wait()
-        if p.returncode != 0:
-            raise DiskImageError('Error attaching {0}'.format(self.image))
+    def __repr__(self):
+        if self.error is not None:
+            return '{0} {1} {2} after {3:d} attempts: {4}'.format(
+                self.image.name, self.action, self.status, self.attempts, self.error
+            )
+        return '{0} {1} {2}'.format(self.image.name, self.action, self.status)
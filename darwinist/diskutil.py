@@ -4,16 +4,18 @@ Wrapper for OS/X diskutil command for python
 
 import os
 import plistlib
+import re
 from xml.parsers.expat import ExpatError
 from subprocess import Popen, PIPE
 
-from io import BytesIO
+from darwinist.corestorage import StorageIndex
+from darwinist.mounts import MountTableCache
 
 INFO_FIELD_MAP = {
     'DeviceNode':       {'name': 'Device', 'value': lambda x: str(x)},
     'FilesystemName':   {'name': 'Filesystem', 'value': lambda x: str(x)},
     'UsedSpace':        {'name': 'Used', 'value': lambda x: x/1024},
-    'UsedPercent':      {'name': 'Percent', 'value': lambda x: x/1024},
+    'UsedPercent':      {'name': 'Percent', 'value': lambda x: round(x, 1)},
     'FreeSpace':        {'name': 'Free', 'value': lambda x: x/1024},
     'TotalSize':        {'name': 'Sizd', 'value': lambda x: x/1024},
     'VolumeName':       {'name': 'Volume Name', 'value': lambda x: str(x)},
@@ -30,27 +32,298 @@ INFO_FIELD_ORDER = [
 ]
 
 
+# DiskInfo fields available from os.statvfs without running diskutil
+CAPACITY_FIELDS = (
+    'MountPoint',
+    'TotalSize',
+    'FreeSpace',
+    'UsedSpace',
+    'UsedPercent',
+)
+
+# Map 'diskutil info' text output fields to 'diskutil info -plist' keys
+TEXT_INFO_FIELD_MAP = {
+    'Device Identifier':        'DeviceIdentifier',
+    'Device Node':              'DeviceNode',
+    'Whole':                    'WholeDisk',
+    'Part of Whole':            'ParentWholeDisk',
+    'Device / Media Name':      'MediaName',
+    'Volume Name':              'VolumeName',
+    'Mounted':                  'Mounted',
+    'Mount Point':              'MountPoint',
+    'Content (IOContent)':      'Content',
+    'File System Personality':  'FilesystemPersonality',
+    'Type (Bundle)':            'FilesystemType',
+    'Name (User Visible)':      'FilesystemName',
+    'Volume UUID':              'VolumeUUID',
+    'Disk / Partition UUID':    'DiskUUID',
+    'Disk Size':                'TotalSize',
+    'Volume Free Space':        'FreeSpace',
+    'Volume Available Space':   'FreeSpace',
+    'Container Total Space':    'APFSContainerSize',
+    'Container Free Space':     'APFSContainerFree',
+    'Device Block Size':        'DeviceBlockSize',
+    'Protocol':                 'BusProtocol',
+    'Read-Only Media':          'WritableMedia',
+    'Read-Only Volume':         'WritableVolume',
+    'Internal':                 'Internal',
+    'Solid State':              'SolidState',
+    'Removable Media':          'RemovableMedia',
+}
+
+# Boolean text fields with inverted meaning compared to the plist keys
+TEXT_INFO_INVERTED_FIELDS = (
+    'WritableMedia',
+    'WritableVolume',
+)
+
+RE_TEXT_INFO_BYTES = re.compile(r'\((?P<bytes>\d+) Bytes\)')
+RE_TEXT_INFO_SEPARATOR = re.compile(r'^\*+$')
+
+
+# Cached disk details, invalidated when the mount table changes
+DISK_INFO_CACHE = MountTableCache()
+
+
 class DiskUtilError(Exception):
     pass
 
 
-class DiskInfo(dict):
-    def __init__(self, device):
-        if not os.access(device, os.R_OK):
-            raise DiskUtilError('Device not readable: {0}'.format(device))
+def used_percent(used, free):
+    """
+    Return used space as float percentage of used and free space
+    """
+    if used + free <= 0:
+        return 0.0
+    return 100.0 * used / (used + free)
+
+
+def parse_text_info(data):
+    """
+    Parse output of 'diskutil info' for one or more devices to dictionaries
+
+    Keys are mapped to the keys used in 'diskutil info -plist' output where
+    known. Sizes are converted to integer bytes and Yes/No values to booleans.
+    """
+    devices = []
+    details = {}
+    for line in data.splitlines():
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        line = line.strip()
+
+        if RE_TEXT_INFO_SEPARATOR.match(line):
+            if details:
+                devices.append(details)
+            details = {}
+            continue
+
+        try:
+            key, value = [x.strip() for x in line.split(':', 1)]
+        except ValueError:
+            continue
+
+        key = TEXT_INFO_FIELD_MAP.get(key, key)
+        if key == 'MountPoint' and not value.startswith(os.sep):
+            continue
+
+        m = RE_TEXT_INFO_BYTES.search(value)
+        if m:
+            value = int(m.group('bytes'))
+        elif value in ('Yes', 'No'):
+            value = value == 'Yes'
+            if key in TEXT_INFO_INVERTED_FIELDS:
+                value = not value
+        elif key == 'RemovableMedia':
+            value = value != 'Fixed'
+
+        details[key] = value
 
-        cmd = ('diskutil', 'info', '-plist', device)
+    if details:
+        devices.append(details)
+    return devices
+
+
+class DiskTopology(list, StorageIndex):
+    """
+    Snapshot of all disks and volumes on the host
+
+    Loaded with one 'diskutil list -plist' and one 'diskutil info -all' call.
+    Device details are indexed by device, mount point and UUID.
+    """
+    def __init__(self):
+        self.whole_disks = []
+        self.mountpoints = {}
+        self.reset_index()
+        self.update()
+
+    def __str__(self):
+        return '{0:d} devices'.format(len(self))
+
+    def update(self):
+        """
+        Update all disk and volume details
+        """
+        cmd = ('diskutil', 'list', '-plist')
         p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
         stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise DiskUtilError('Error running {0}: {1}'.format(' '.join(cmd), stderr))
         try:
-            plist = BytesIO(stdout)
-            self.update(plistlib.readPlist(plist))
-        except ExpatError:
+            data = plistlib.loads(stdout)
+        except (ExpatError, ValueError):
             raise DiskUtilError('Error parsing plist: {0}'.format(stdout))
 
+        cmd = ('diskutil', 'info', '-all')
+        p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise DiskUtilError('Error running {0}: {1}'.format(' '.join(cmd), stderr))
+
+        del self[:]
+        self.whole_disks = data.get('WholeDisks', [])
+        self.mountpoints = {}
+        self.reset_index()
+
+        devices = {}
+        for disk in data.get('AllDisksAndPartitions', []):
+            for entry in [disk] + disk.get('Partitions', []) + disk.get('APFSVolumes', []):
+                details = dict((k, v) for k, v in entry.items() if k not in ('Partitions', 'APFSVolumes'))
+                if 'Size' in details:
+                    details['TotalSize'] = details.pop('Size')
+                devices[entry['DeviceIdentifier']] = details
+
+        for details in parse_text_info(stdout):
+            if 'DeviceIdentifier' not in details:
+                continue
+            devices.setdefault(details['DeviceIdentifier'], {}).update(details)
+
+        for identifier in sorted(devices):
+            details = devices[identifier]
+            details.setdefault('DeviceIdentifier', identifier)
+            details.setdefault('DeviceNode', '/dev/{0}'.format(identifier))
+            self.append(details)
+            self.add_index(details, details.get('VolumeUUID', None), identifier)
+            if details.get('DiskUUID', None):
+                self.uuids.setdefault(details['DiskUUID'].upper(), details)
+            if details.get('MountPoint', None):
+                self.mountpoints[details['MountPoint']] = details
+
+    def find_mountpoint(self, path):
+        """
+        Return details for volume mounted on path or None
+        """
+        if path != os.sep:
+            path = path.rstrip(os.sep)
+        return self.mountpoints.get(path, None)
+
+    def lookup(self, value):
+        """
+        Return details for device, mount point or UUID or None
+        """
+        if value.startswith(os.sep) and not value.startswith('/dev/'):
+            return self.find_mountpoint(value)
+        return super(DiskTopology, self).lookup(value)
+
+
+class DiskUsage(dict):
+    """
+    Capacity of a mounted volume from os.statvfs
+
+    Does not run any subprocesses. Keys match the DiskInfo capacity keys.
+    Free space is the space available to unprivileged users.
+    """
+    def __init__(self, mountpoint):
+        try:
+            st = os.statvfs(mountpoint)
+        except OSError as e:
+            raise DiskUtilError('Error checking {0}: {1}'.format(mountpoint, e))
+
+        free = st.f_bavail * st.f_frsize
+        used = (st.f_blocks - st.f_bfree) * st.f_frsize
+        self['MountPoint'] = mountpoint
+        self['TotalSize'] = st.f_blocks * st.f_frsize
+        self['FreeSpace'] = free
+        self['UsedSpace'] = used
+        self['UsedPercent'] = used_percent(used, free)
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError('No such DiskUsage attribute: {0}'.format(attr))
+
+
+class DiskInfo(dict):
+    """
+    Disk details for a device or mount point
+
+    If topology is given, details are looked up from the DiskTopology
+    snapshot instead of running diskutil for the device.
+
+    For mount points, capacity fields are read with os.statvfs and diskutil
+    is only run when some other field is accessed.
+    """
+    def __init__(self, device, topology=None):
+        self.device = device
+        self.__loaded__ = True
+
+        if topology is not None:
+            details = topology.lookup(device)
+            if details is None:
+                raise DiskUtilError('No such device: {0}'.format(device))
+            self.update(details)
+
+        elif os.path.ismount(device):
+            self.update(DiskUsage(device))
+            self.__loaded__ = False
+            return
+
+        else:
+            self.__load__()
+
         if 'TotalSize' in self and 'FreeSpace' in self:
             self['UsedSpace'] = self.TotalSize - self.FreeSpace
-            self['UsedPercent'] = int(round(1-(float(self.FreeSpace) / float(self.TotalSize))))
+            self['UsedPercent'] = used_percent(self.UsedSpace, self.FreeSpace)
+
+    def __load__(self):
+        """
+        Load details with diskutil, keeping existing capacity fields
+        """
+        self.__loaded__ = True
+
+        if not os.access(self.device, os.R_OK):
+            raise DiskUtilError('Device not readable: {0}'.format(self.device))
+
+        cmd = ('diskutil', 'info', '-plist', self.device)
+        p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = p.communicate()
+        try:
+            details = plistlib.loads(stdout)
+        except (ExpatError, ValueError):
+            raise DiskUtilError('Error parsing plist: {0}'.format(stdout))
+
+        for key, value in details.items():
+            if key not in CAPACITY_FIELDS or not dict.__contains__(self, key):
+                self[key] = value
+
+    def __missing__(self, key):
+        if not self.__loaded__:
+            self.__load__()
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key) and not self.__loaded__:
+            self.__load__()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
     def __getattr__(self, attr):
         try:
@@ -62,6 +335,8 @@ class DiskInfo(dict):
         """
         Return keys as sorted list
         """
+        if not self.__loaded__:
+            self.__load__()
         return sorted(super(DiskInfo, self).keys())
 
     def items(self):
@@ -75,3 +350,20 @@ class DiskInfo(dict):
         Return values sorted by key
         """
         return [self[k] for k in self.keys()]
+
+
+def cached_topology():
+    """
+    Return DiskTopology, cached until the mount table changes
+    """
+    return DISK_INFO_CACHE.lookup('topology', DiskTopology)
+
+
+def cached_disk_info(device):
+    """
+    Return DiskInfo for device, cached until the mount table changes
+
+    Capacity fields are not updated while cached, use DiskUsage for current
+    free space.
+    """
+    return DISK_INFO_CACHE.lookup(('info', device), lambda: DiskInfo(device, topology=cached_topology()))
@@ -2,84 +2,432 @@
 Parse and list network interfaces on the system
 """
 
-import re
+import ipaddress
 from subprocess import Popen, PIPE
 from seine.address import EthernetMACAddress, IPv4Address, IPv6Address
 
-RE_INET_LINE = [
-    re.compile('^\s+inet\s+(?P<address>[0-9.]+)\s+netmask\s+(?P<netmask>[.x0-9a-f]+)$'),
-    re.compile('^\s+inet\s+(?P<address>[0-9.]+)\s+netmask\s+(?P<netmask>[.x0-9a-f]+)\s+broadcast\s+(?P<broadcast>[0-9.]+)$'), # noqa
-]
-RE_INET6_LINE = [
-    re.compile('^\s+inet6\s+(?P<address>[0-9:a-f]+)\s+prefixlen\s+(?P<prefix>\d+)$'),
-    re.compile('^\s+inet6\s+(?P<address>[0-9:a-f]+)%(?P<scope>[^s]+)\s+prefixlen\s+(?P<prefix>\d+)\s+scopeid\s+(?P<scope_id>[x0-9a-f]+)$'), # noqa
-]
+from darwinist.netstat import InterfaceTrafficSampler
+
+IFCONFIG_COMMAND = ('/sbin/ifconfig', '-a')
+
+# Address fields converted to seine address objects on first access
+ADDRESS_FIELD_TYPES = {
+    'IPv4': {
+        'address': IPv4Address,
+        'netmask': IPv4Address,
+        'broadcast': IPv4Address,
+        'destination': IPv4Address,
+    },
+    'IPv6': {
+        'address': IPv6Address,
+    },
+}
+
+# Interface fields converted to seine address objects on first access
+INTERFACE_FIELD_TYPES = {
+    'ether': EthernetMACAddress,
+}
+
+# Tokens in inet and inet6 lines with a value in the next token
+ADDRESS_VALUE_TOKENS = {
+    'netmask': 'netmask',
+    'broadcast': 'broadcast',
+    '-->': 'destination',
+    'prefixlen': 'prefix',
+    'scopeid': 'scope_id',
+    'vhid': 'vhid',
+}
+
+
+class InterfaceError(Exception):
+    pass
+
+
+def netmask_prefixlen(netmask):
+    """
+    Return prefix length for IPv4 netmask in hex (0xffffff00) or dotted format
+    """
+    try:
+        if netmask.startswith('0x'):
+            value = int(netmask, 16)
+        else:
+            value = int(ipaddress.IPv4Address(netmask))
+    except ValueError:
+        raise InterfaceError('Invalid netmask: {0}'.format(netmask))
+    return bin(value).count('1')
+
+
+class PrefixTrie(object):
+    """
+    Binary prefix trie for longest prefix match of IPv4 or IPv6 addresses
+
+    Nodes are lists [zero child, one child, value]. Lookups walk at most
+    the longest stored prefix length bits of the address.
+    """
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+        self.max_prefixlen = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, value, prefixlen, item, replace=False):
+        """
+        Store item for network given as integer value and prefix length
+        """
+        node = self.root
+        for shift in range(self.bits - 1, self.bits - 1 - prefixlen, -1):
+            bit = (value >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+
+        if node[2] is None:
+            self.count += 1
+        elif not replace:
+            return
+        node[2] = item
+        self.max_prefixlen = max(self.max_prefixlen, prefixlen)
+
+    def lookup(self, value):
+        """
+        Return item for longest prefix matching integer value or None
+        """
+        node = self.root
+        match = node[2]
+        shift = self.bits - 1
+        stop = self.bits - 1 - self.max_prefixlen
+        while shift > stop:
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+            shift -= 1
+        return match
+
+
+def normalize_address(value):
+    """
+    Return IP address string in canonical format used in address indexes
+    """
+    try:
+        return ipaddress.ip_address(str(value).split('%', 1)[0]).compressed
+    except ValueError:
+        raise InterfaceError('Invalid address: {0}'.format(value))
 
 
 class NetworkInterfaces(list):
-    def __init__(self):
-        p = Popen(['/sbin/ifconfig'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-        stdout, stderr = p.communicate()
+    """
+    Network interfaces parsed from one 'ifconfig -a' call
+
+    Interfaces are indexed by name, MAC address and IP address. Address
+    objects are only constructed when accessed. Output of ifconfig can be
+    given as data for parsing instead of running the command.
+    """
+    def __init__(self, data=None):
+        self.names = {}
+        self.macs = {}
+        self.addresses = {}
+        self.__prefixes__ = None
+        self.__scope_prefixes__ = None
+
+        if data is None:
+            p = Popen(IFCONFIG_COMMAND, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            data, stderr = p.communicate()
+            if p.returncode != 0:
+                raise InterfaceError('Error running {0}: {1}'.format(' '.join(IFCONFIG_COMMAND), stderr))
+
+        if isinstance(data, bytes):
+            data = data.decode('utf-8', 'replace')
 
         interface = None
-        for line in [x.rstrip() for x in stdout.split('\n')]:
-            if line.strip() == '':
+        for line in data.splitlines():
+            if not line or line.isspace():
                 continue
 
-            if line.startswith('	'):
+            if line[0].isspace():
+                if interface is None:
+                    raise InterfaceError('Error parsing line {0}'.format(line))
                 interface.parse(line)
 
             else:
                 name, flags = line.split(':', 1)
-                if interface:
-                    self.append(interface)
-                interface = Interface(name, flags)
+                interface = Interface(name, flags.strip())
+                self.append(interface)
+
+        for interface in self:
+            self.__add_index__(interface)
+
+    def __add_index__(self, interface):
+        self.names[interface.name] = interface
+        if interface.mac is not None:
+            self.macs.setdefault(interface.mac, interface)
+        for address in interface['addresses']:
+            self.addresses.setdefault(address.key, (interface, address))
+
+    @property
+    def prefixes(self):
+        """
+        Prefix tries for IPv4 and IPv6 networks of all interfaces
+
+        Built on first access. Items are tuples (interface, network) where
+        network is ipaddress network object. Point to point destination
+        addresses are added as host routes. For networks configured on many
+        interfaces the first interface is stored. Addresses with scope are
+        also stored in scope_prefixes.
+        """
+        if self.__prefixes__ is not None:
+            return self.__prefixes__
+
+        prefixes = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        scopes = {}
+        for interface in self:
+            for address in interface['addresses']:
+                try:
+                    if address['addr_type'] == 'IPv4':
+                        netmask = address.raw('netmask')
+                        prefixlen = netmask_prefixlen(netmask) if netmask is not None else 32
+                    else:
+                        prefixlen = address.get('prefix', None)
+                        if prefixlen is None:
+                            prefixlen = 128
+                    network = ipaddress.ip_network((address.key, prefixlen), strict=False)
+                except (InterfaceError, ValueError):
+                    continue
+
+                prefixes[network.version].insert(
+                    int(network.network_address), network.prefixlen, (interface, network)
+                )
+                if 'scope' in address:
+                    if address['scope'] not in scopes:
+                        scopes[address['scope']] = PrefixTrie(128)
+                    scopes[address['scope']].insert(
+                        int(network.network_address), network.prefixlen, (interface, network)
+                    )
+
+                destination = address.raw('destination')
+                if destination is not None:
+                    try:
+                        host = ipaddress.ip_network(normalize_address(destination))
+                    except (InterfaceError, ValueError):
+                        continue
+                    prefixes[host.version].insert(int(host.network_address), host.prefixlen, (interface, host))
+
+        self.__scope_prefixes__ = scopes
+        self.__prefixes__ = prefixes
+        return prefixes
+
+    @property
+    def scope_prefixes(self):
+        """
+        Prefix tries for IPv6 networks of scoped addresses by scope interface name
+        """
+        if self.__scope_prefixes__ is None:
+            self.prefixes
+        return self.__scope_prefixes__
+
+    def lookup(self, address):
+        """
+        Return tuple (interface, network) for longest prefix matching address
+
+        IPv6 addresses with scope like fe80::1%en0 are looked up from networks
+        of the scope interface. Returns None if address is not in any local
+        network.
+        """
+        value = str(address)
+        scope = None
+        if '%' in value:
+            value, scope = value.split('%', 1)
+        try:
+            address = ipaddress.ip_address(value)
+        except ValueError:
+            raise InterfaceError('Invalid address: {0}'.format(address))
+
+        if scope is not None and scope in self.scope_prefixes:
+            match = self.scope_prefixes[scope].lookup(int(address))
+            if match is not None:
+                return match
+        return self.prefixes[address.version].lookup(int(address))
+
+    def traffic_sampler(self):
+        """
+        Return InterfaceTrafficSampler for traffic rates of these interfaces
+        """
+        return InterfaceTrafficSampler(self)
+
+    def find_name(self, name):
+        """
+        Return interface with name or None
+        """
+        return self.names.get(name, None)
+
+    def find_mac(self, mac):
+        """
+        Return first interface with MAC address or None
+        """
+        return self.macs.get(str(mac).lower(), None)
+
+    def find_address(self, address):
+        """
+        Return tuple (interface, address details) for IP address or None
+
+        IPv6 scope is ignored, link local addresses present on many interfaces
+        return the first interface.
+        """
+        try:
+            return self.addresses.get(normalize_address(address), None)
+        except InterfaceError:
+            return None
+
+
+class InterfaceAddress(dict):
+    """
+    IPv4 or IPv6 address configured on an interface
+
+    Address fields are stored as strings and converted to seine address
+    objects on first access.
+    """
+    def __init__(self, addr_type, address):
+        self['addr_type'] = addr_type
+        self.__raw__ = {}
+        self.__types__ = ADDRESS_FIELD_TYPES[addr_type]
+
+        if '%' in address:
+            address, self['scope'] = address.split('%', 1)
+        self.__raw__['address'] = address
+        self.key = normalize_address(address)
+
+    def __repr__(self):
+        return self.__raw__['address']
+
+    def set_field(self, key, value):
+        """
+        Set field from ifconfig string value
+        """
+        if key in self.__types__:
+            self.__raw__[key] = value
+            dict.pop(self, key, None)
+        elif key == 'prefix':
+            self[key] = int(value)
+        else:
+            self[key] = value
+
+    def __missing__(self, key):
+        if key in self.__raw__:
+            value = self.__types__[key](self.__raw__[key])
+            self[key] = value
+            return value
+        if key in self.__types__:
+            return None
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.__raw__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return sorted(set(dict.keys(self)) | set(self.__raw__))
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def raw(self, key):
+        """
+        Return field as string without constructing address object
+        """
+        if key in self.__raw__:
+            return self.__raw__[key]
+        value = dict.get(self, key, None)
+        return value is not None and str(value) or None
 
 
 class Interface(dict):
     def __init__(self, name, flags=''):
         self.name = name
         self.flags = flags
+        self.__raw__ = {}
         self['addresses'] = []
 
+    def __repr__(self):
+        return self.name
+
+    def __missing__(self, key):
+        if key in self.__raw__:
+            value = INTERFACE_FIELD_TYPES[key](self.__raw__[key])
+            self[key] = value
+            return value
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.__raw__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return sorted(set(dict.keys(self)) | set(self.__raw__))
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    @property
+    def mac(self):
+        """
+        MAC address as lower case string or None
+        """
+        value = self.__raw__.get('ether', None)
+        return value is not None and value.lower() or None
+
     def parse(self, line):
         """
         Parse a configuration line for interface
         """
+        fields = line.split()
+        key = fields[0]
 
-        for inet_re in RE_INET_LINE:
-            m = inet_re.match(line)
-            if m:
-                data = m.groupdict()
-                data['addr_type'] = 'IPv4'
-                data['address'] = IPv4Address(data['address'])
-                data['netmask'] = IPv4Address(data['netmask'])
-                if 'broadcast' in data:
-                    data['broadcast'] = IPv4Address(data['broadcast'])
+        if key in ('inet', 'inet6') and len(fields) > 1:
+            address = InterfaceAddress(key == 'inet' and 'IPv4' or 'IPv6', fields[1])
+            flags = []
+            index = 2
+            while index < len(fields):
+                token = fields[index]
+                if token in ADDRESS_VALUE_TOKENS and index + 1 < len(fields):
+                    address.set_field(ADDRESS_VALUE_TOKENS[token], fields[index + 1])
+                    index += 2
                 else:
-                    data['broadcast'] = None
+                    flags.append(token)
+                    index += 1
+            if address['addr_type'] == 'IPv4' and 'broadcast' not in address:
+                address['broadcast'] = None
+            if flags:
+                address['flags'] = flags
+            self['addresses'].append(address)
+            return
 
-                self['addresses'].append(data)
+        if len(fields) > 1:
+            value = line.strip()[len(key):].strip()
+            if key in INTERFACE_FIELD_TYPES:
+                self.__raw__[key] = value
+                dict.pop(self, key, None)
                 return
-
-        for inet6_re in RE_INET6_LINE:
-            m = inet6_re.match(line)
-            if m:
-                data = m.groupdict()
-                data['addr_type'] = 'IPv6'
-                data['address'] = IPv6Address(data['address'])
-                if 'prefix' in data:
-                    data['prefix'] = int(data['prefix'])
-
-                self['addresses'].append(data)
-                return
-
-        try:
-            key, value = line.strip().split(None, 1)
-            if key == 'ether':
-                value = EthernetMACAddress(value)
-
-        except ValueError:
+        else:
             try:
                 key, value = line.strip().split('=', 1)
             except ValueError:
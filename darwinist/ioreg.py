@@ -4,11 +4,23 @@ Module to parse output from 'ioreg' command to python data structures
 
 import os
 import re
+import time
 from subprocess import Popen, PIPE
 
 IOREG_COMMAND = '/usr/sbin/ioreg'
 
 RE_IOREG_HEADER = re.compile('^\+-o\s(?P<name>.*)\s+<class (?P<ioclass>[\w]+),(?P<flags>[^>]*)')
+RE_IOREG_ENTRY_ID = re.compile(r'\bid (?P<id>0x[0-9a-fA-F]+)')
+
+# Default interval in seconds between registry snapshots in IORegWatcher
+DEFAULT_WATCH_INTERVAL = 2
+
+# Registry classes for USB, thunderbolt and storage devices watched by ioreg-watch
+DEFAULT_WATCH_CLASSES = (
+    'IOUSBHostDevice',
+    'IOThunderboltSwitch',
+    'IOMedia',
+)
 
 
 class IORegError(Exception):
@@ -41,10 +53,13 @@ class IORegItem(object):
 class IORegGroup(dict):
     """
     A group of items in ioreg command output
+
+    If keys is given, only items with these keys are stored.
     """
-    def __init__(self, parent, header):
+    def __init__(self, parent, header, keys=None):
         self.parent = parent
         self.name = 'UNPARSED'
+        self.keys_filter = keys
 
         m = RE_IOREG_HEADER.match(header)
         if not m:
@@ -53,9 +68,24 @@ class IORegGroup(dict):
         for k, v in m.groupdict().items():
             setattr(self, k, v.strip())
 
+        m = RE_IOREG_ENTRY_ID.search(self.flags)
+        if m:
+            self.id = int(m.group('id'), 16)
+        else:
+            self.id = None
+
     def __repr__(self):
         return 'IORegGroup {0}'.format(self.name)
 
+    @property
+    def key(self):
+        """
+        Unique key for the registry entry: registry entry ID if known
+        """
+        if self.id is not None:
+            return self.id
+        return (self.ioclass, self.name)
+
     def append(self, line):
         """
         Add an IORegItem entry to this group
@@ -64,6 +94,10 @@ class IORegGroup(dict):
         if line in ['"', '']:
             return
 
+        if self.keys_filter is not None:
+            if line.split('=', 1)[0].rstrip().strip('"') not in self.keys_filter:
+                return
+
         item = IORegItem(line)
         self[item.key] = item
 
@@ -71,12 +105,17 @@ class IORegGroup(dict):
 class IORegTree(list):
     """
     Parser for ioreg output entries to a dictionary
+
+    If ioclass is given, only subtrees rooted at objects of given class are
+    requested from ioreg. If keys is given, other items are not parsed.
     """
-    def __init__(self, path=None):
+    def __init__(self, path=None, ioclass=None, keys=None):
         if not os.access(IOREG_COMMAND, os.X_OK):
             raise IORegError('Not executable: {0}'.format(IOREG_COMMAND))
 
-        if path is not None:
+        if ioclass is not None:
+            cmd = [IOREG_COMMAND, '-r', '-l', '-w0', '-c', ioclass]
+        elif path is not None:
             cmd = [IOREG_COMMAND, '-r', '-w0', '-n', path]
         else:
             cmd = [IOREG_COMMAND, '-lw0']
@@ -91,7 +130,7 @@ class IORegTree(list):
                 continue
 
             elif line[:3] == '+-o':
-                group = IORegGroup(parent, line)
+                group = IORegGroup(parent, line, keys)
                 parent = group
                 self.append(group)
 
@@ -100,3 +139,119 @@ class IORegTree(list):
 
             elif group is not None:
                 group.append(line)
+
+
+class IORegEvent(object):
+    """
+    Registry entry added, removed or changed between two snapshots
+    """
+    def __init__(self, action, group, changes=None):
+        self.action = action
+        self.group = group
+        self.changes = changes is not None and changes or {}
+
+    def __repr__(self):
+        if self.group.id is not None:
+            return '{0} {1} {2} (0x{3:x})'.format(self.action, self.group.ioclass, self.group.name, self.group.id)
+        return '{0} {1} {2}'.format(self.action, self.group.ioclass, self.group.name)
+
+
+class IORegSnapshot(dict):
+    """
+    Snapshot of registry entries, indexed by registry entry ID
+
+    With ioclasses, only the subtrees for given classes are requested.
+    """
+    def __init__(self, ioclasses=None):
+        self.timestamp = time.time()
+
+        if ioclasses:
+            for ioclass in ioclasses:
+                self.__add_tree__(IORegTree(ioclass=ioclass))
+        else:
+            self.__add_tree__(IORegTree())
+
+    def __add_tree__(self, tree):
+        for group in tree:
+            self[group.key] = group
+
+    def diff(self, previous, ignore_properties=()):
+        """
+        Return list of IORegEvent items for changes since previous snapshot
+
+        Changed property events contain the changed keys with (old, new) values,
+        None marking missing values.
+        """
+        events = []
+
+        for key, group in self.items():
+            old = previous.get(key, None)
+            if old is None:
+                events.append(IORegEvent('added', group))
+                continue
+
+            changes = {}
+            for name, item in group.items():
+                if name in ignore_properties:
+                    continue
+                old_item = old.get(name, None)
+                if old_item is None:
+                    changes[name] = (None, item.value)
+                elif old_item.value != item.value:
+                    changes[name] = (old_item.value, item.value)
+
+            for name, item in old.items():
+                if name not in group and name not in ignore_properties:
+                    changes[name] = (item.value, None)
+
+            if changes:
+                events.append(IORegEvent('changed', group, changes))
+
+        for key, group in previous.items():
+            if key not in self:
+                events.append(IORegEvent('removed', group))
+
+        return events
+
+
+class IORegWatcher(object):
+    """
+    Watch registry for added, removed and changed entries
+
+    Snapshots are taken with given interval and compared by registry entry ID.
+    """
+    def __init__(self, ioclasses=None, interval=DEFAULT_WATCH_INTERVAL, ignore_properties=()):
+        self.ioclasses = ioclasses
+        self.interval = interval
+        self.ignore_properties = ignore_properties
+        self.snapshot = None
+
+    def poll(self):
+        """
+        Take a new snapshot and return events since previous poll
+
+        First poll only records the baseline snapshot and returns no events.
+        """
+        snapshot = IORegSnapshot(self.ioclasses)
+        previous = self.snapshot
+        self.snapshot = snapshot
+
+        if previous is None:
+            return []
+        return snapshot.diff(previous, self.ignore_properties)
+
+    def watch(self, count=None):
+        """
+        Generator to yield events from snapshots taken every interval seconds
+
+        Runs forever unless count of polls is given.
+        """
+        if self.snapshot is None:
+            self.poll()
+
+        polls = 0
+        while count is None or polls < count:
+            time.sleep(self.interval)
+            for event in self.poll():
+                yield event
+            polls += 1
@@ -0,0 +1,168 @@
+"""
+Mount table access and change detection
+
+The mount table is read with getfsstat(2) on OS/X, without running any
+commands. The fingerprint of the table is used to invalidate caches of disk
+details when volumes are mounted or unmounted.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import sys
+
+from subprocess import check_output, CalledProcessError
+
+MNT_NOWAIT = 2
+MFSTYPENAMELEN = 16
+MAXPATHLEN = 1024
+
+PROC_MOUNTS = '/proc/self/mounts'
+
+
+class MountError(Exception):
+    pass
+
+
+class StatFS(ctypes.Structure):
+    """
+    struct statfs with 64 bit inodes from sys/mount.h
+    """
+    _fields_ = [
+        ('f_bsize', ctypes.c_uint32),
+        ('f_iosize', ctypes.c_int32),
+        ('f_blocks', ctypes.c_uint64),
+        ('f_bfree', ctypes.c_uint64),
+        ('f_bavail', ctypes.c_uint64),
+        ('f_files', ctypes.c_uint64),
+        ('f_ffree', ctypes.c_uint64),
+        ('f_fsid', ctypes.c_int32 * 2),
+        ('f_owner', ctypes.c_uint32),
+        ('f_type', ctypes.c_uint32),
+        ('f_flags', ctypes.c_uint32),
+        ('f_fssubtype', ctypes.c_uint32),
+        ('f_fstypename', ctypes.c_char * MFSTYPENAMELEN),
+        ('f_mntonname', ctypes.c_char * MAXPATHLEN),
+        ('f_mntfromname', ctypes.c_char * MAXPATHLEN),
+        ('f_flags_ext', ctypes.c_uint32),
+        ('f_reserved', ctypes.c_uint32 * 7),
+    ]
+
+
+def __load_getfsstat__():
+    """
+    Return getfsstat function from libc with 64 bit inode struct, or None
+    """
+    if sys.platform != 'darwin':
+        return None
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    for name in ('getfsstat$INODE64', 'getfsstat'):
+        try:
+            function = getattr(libc, name)
+        except AttributeError:
+            continue
+        function.argtypes = (ctypes.c_void_p, ctypes.c_int, ctypes.c_int)
+        function.restype = ctypes.c_int
+        return function
+    return None
+
+
+getfsstat = __load_getfsstat__()
+
+
+def __read_getfsstat__():
+    count = getfsstat(None, 0, MNT_NOWAIT)
+    if count < 0:
+        raise MountError('getfsstat failed: {0}'.format(os.strerror(ctypes.get_errno())))
+
+    # Leave room for volumes mounted between the calls
+    buffer = (StatFS * (count + 8))()
+    count = getfsstat(buffer, ctypes.sizeof(buffer), MNT_NOWAIT)
+    if count < 0:
+        raise MountError('getfsstat failed: {0}'.format(os.strerror(ctypes.get_errno())))
+
+    return [
+        (
+            entry.f_mntfromname.decode('utf-8', 'replace'),
+            entry.f_mntonname.decode('utf-8', 'replace'),
+            entry.f_fstypename.decode('utf-8', 'replace'),
+        )
+        for entry in buffer[:count]
+    ]
+
+
+def __read_proc_mounts__():
+    mounts = []
+    with open(PROC_MOUNTS, 'r') as fd:
+        for line in fd:
+            fields = line.split()
+            if len(fields) >= 3:
+                mounts.append((fields[0], fields[1], fields[2]))
+    return mounts
+
+
+def __read_mount_command__():
+    try:
+        output = check_output(('mount',))
+    except (OSError, CalledProcessError) as e:
+        raise MountError('Error running mount: {0}'.format(e))
+
+    mounts = []
+    for line in output.decode('utf-8', 'replace').splitlines():
+        try:
+            device, details = line.split(' on ', 1)
+            mountpoint, options = details.rsplit(' (', 1)
+        except ValueError:
+            continue
+        mounts.append((device, mountpoint, options.split(',', 1)[0].rstrip(')')))
+    return mounts
+
+
+def read_mount_table():
+    """
+    Return list of (device, mountpoint, fstype) tuples for mounted filesystems
+    """
+    if getfsstat is not None:
+        return __read_getfsstat__()
+    if os.path.isfile(PROC_MOUNTS):
+        return __read_proc_mounts__()
+    return __read_mount_command__()
+
+
+def mount_table_fingerprint():
+    """
+    Return hash of the (device, mountpoint, fstype) entries in mount table
+    """
+    return hash(tuple(sorted(read_mount_table())))
+
+
+class MountTableCache(dict):
+    """
+    Cache which is cleared when the mount table changes
+
+    Values are loaded with a loader function on first lookup after a change.
+    """
+    def __init__(self):
+        self.fingerprint = None
+
+    def check(self):
+        """
+        Clear cache if mount table has changed since last check
+        """
+        fingerprint = mount_table_fingerprint()
+        if fingerprint != self.fingerprint:
+            self.clear()
+            self.fingerprint = fingerprint
+
+    def lookup(self, key, loader):
+        """
+        Return cached value for key, calling loader() to load missing values
+        """
+        self.check()
+        try:
+            return self[key]
+        except KeyError:
+            value = loader()
+            self[key] = value
+            return value
@@ -0,0 +1,225 @@
+"""
+Network interface traffic counters from netstat
+
+Counters for all interfaces are read with one 'netstat -ibnd' call per
+sample. Only the link level rows are parsed.
+"""
+
+import time
+
+from subprocess import Popen, PIPE
+
+NETSTAT_COMMAND = ('/usr/sbin/netstat', '-i', '-b', '-n', '-d')
+
+# Counter columns in netstat interface output, lower case
+NETSTAT_COUNTER_FIELDS = (
+    'ipkts',
+    'ierrs',
+    'ibytes',
+    'opkts',
+    'oerrs',
+    'obytes',
+    'coll',
+    'drop',
+)
+
+LINK_NETWORK_PREFIX = '<Link#'
+
+DEFAULT_TRAFFIC_INTERVAL = 1
+
+COUNTER_WRAP_32 = 2 ** 32
+COUNTER_WRAP_64 = 2 ** 64
+
+
+class NetstatError(Exception):
+    pass
+
+
+def counter_delta(previous, current):
+    """
+    Return increase of counter between two values
+
+    Counters which went backwards are assumed to have wrapped at 32 or 64
+    bits. If the wrapped difference is implausibly large, the counter is
+    assumed to have been reset and the current value is returned.
+    """
+    if current >= previous:
+        return current - previous
+
+    wrap = previous < COUNTER_WRAP_32 and COUNTER_WRAP_32 or COUNTER_WRAP_64
+    delta = current + wrap - previous
+    if delta > wrap // 2:
+        return current
+    return delta
+
+
+def parse_netstat_counters(data):
+    """
+    Parse 'netstat -ib' output to dictionary of counter tuples by interface name
+
+    Returns tuple (columns, counters), where columns are the lower case
+    counter column names in order of values in counter tuples. Missing
+    values shown as '-' are returned as 0.
+    """
+    if isinstance(data, bytes):
+        data = data.decode('utf-8', 'replace')
+
+    lines = data.splitlines()
+    if not lines:
+        raise NetstatError('No netstat output')
+
+    header = lines[0].split()
+    try:
+        first = header.index('Ipkts')
+    except ValueError:
+        raise NetstatError('Error parsing netstat header: {0}'.format(lines[0]))
+    columns = tuple(x.lower() for x in header[first:])
+    count = len(columns)
+
+    counters = {}
+    for line in lines[1:]:
+        if LINK_NETWORK_PREFIX not in line:
+            continue
+
+        fields = line.split()
+        name = fields[0].rstrip('*')
+        if name in counters or len(fields) < count + 1:
+            continue
+
+        try:
+            counters[name] = tuple(x != '-' and int(x) or 0 for x in fields[-count:])
+        except ValueError:
+            raise NetstatError('Error parsing line: {0}'.format(line))
+
+    return columns, counters
+
+
+class InterfaceCounters(dict):
+    """
+    Counters of all interfaces from one netstat call
+
+    Maps interface name to tuple of counter values in order of columns.
+    Output of netstat can be given as data for parsing instead of running
+    the command.
+    """
+    def __init__(self, data=None):
+        self.timestamp = time.time()
+
+        if data is None:
+            p = Popen(NETSTAT_COMMAND, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+            data, stderr = p.communicate()
+            if p.returncode != 0:
+                raise NetstatError('Error running {0}: {1}'.format(' '.join(NETSTAT_COMMAND), stderr))
+
+        self.columns, counters = parse_netstat_counters(data)
+        self.update(counters)
+
+    def counter(self, name, field):
+        """
+        Return value of counter field for interface
+        """
+        try:
+            return self[name][self.columns.index(field)]
+        except (KeyError, ValueError):
+            raise NetstatError('No counter {0} for interface {1}'.format(field, name))
+
+
+class InterfaceRates(dict):
+    """
+    Per second counter rates of one interface between two samples
+
+    Keys are the counter column names. If NetworkInterfaces was given to
+    the sampler, interface is the matching Interface or None.
+    """
+    def __init__(self, name, columns, rates, elapsed, interface=None):
+        self.name = name
+        self.elapsed = elapsed
+        self.interface = interface
+        self.update(zip(columns, rates))
+
+    def __repr__(self):
+        return '{0} in {1:.0f} B/s out {2:.0f} B/s'.format(
+            self.name, self.get('ibytes', 0), self.get('obytes', 0)
+        )
+
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError('No such InterfaceRates attribute: {0}'.format(attr))
+
+
+class InterfaceTrafficSampler(object):
+    """
+    Interface traffic sampler
+
+    Each sample runs netstat once and computes per second rates of all
+    counters since the previous sample with wraparound safe deltas. Rates
+    are stored to rates by interface name. With NetworkInterfaces given,
+    only interfaces in it are sampled and rates are linked to them.
+    """
+    def __init__(self, interfaces=None):
+        self.interfaces = interfaces
+        self.previous = None
+        self.rates = {}
+
+    def __repr__(self):
+        return 'InterfaceTrafficSampler {0:d} interfaces'.format(len(self.rates))
+
+    def __getitem__(self, name):
+        return self.rates[name]
+
+    def sample(self):
+        """
+        Read counters and update rates
+
+        Returns the rates dictionary, which is empty after first sample.
+        """
+        counters = InterfaceCounters()
+        previous = self.previous
+        self.previous = counters
+        if previous is None:
+            return self.rates
+
+        elapsed = counters.timestamp - previous.timestamp
+        if elapsed <= 0 or counters.columns != previous.columns:
+            return self.rates
+
+        rates = {}
+        for name, values in counters.items():
+            interface = None
+            if self.interfaces is not None:
+                interface = self.interfaces.find_name(name)
+                if interface is None:
+                    continue
+
+            old = previous.get(name, None)
+            if old is None:
+                continue
+
+            rates[name] = InterfaceRates(
+                name,
+                counters.columns,
+                [counter_delta(a, b) / elapsed for a, b in zip(old, values)],
+                elapsed,
+                interface,
+            )
+
+        self.rates = rates
+        return self.rates
+
+    def watch(self, interval=DEFAULT_TRAFFIC_INTERVAL, count=None):
+        """
+        Generator to sample counters every interval seconds
+
+        Yields the rates dictionary after each sample with rates. Runs
+        forever unless count is given.
+        """
+        if self.previous is None:
+            self.sample()
+
+        samples = 0
+        while count is None or samples < count:
+            time.sleep(interval)
+            yield self.sample()
+            samples += 1
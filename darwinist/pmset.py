@@ -0,0 +1,212 @@
+"""
+Streaming parser for 'pmset -g log' power management event log
+
+The log is processed line by line with generators, so memory use does not
+depend on the log size.
+"""
+
+import re
+
+from collections import Counter
+from datetime import datetime, timedelta
+from subprocess import Popen, PIPE
+
+PMSET_COMMAND = '/usr/bin/pmset'
+
+PMSET_TIME_FORMAT = '%Y-%m-%d %H:%M:%S %z'
+
+RE_PMSET_LINE = re.compile(
+    r'^(?P<timestamp>\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2} [+-]\d{4}) (?P<domain>\S.*?)(?:\t|\s{2,})(?P<message>.*)$'
+)
+RE_PMSET_DURATION = re.compile(r'\s(?P<duration>\d+) secs\s*$')
+RE_PMSET_POWER_SOURCE = re.compile(r'Using (?P<source>AC|Batt|BATT)\b')
+RE_PMSET_CHARGE = re.compile(r'\(Charge:\s*(?P<charge>\d+)%\)')
+RE_PMSET_SLEEP_REASON = re.compile(r"due to '(?P<reason>[^']+)'")
+RE_PMSET_WAKE_REASON = re.compile(r'due to (?P<reason>.*?)(?:\s+Using (?:AC|Batt|BATT)\b|\s+\d+ secs\s*$|$)')
+RE_PMSET_ASSERTION = re.compile(r'^PID (?P<pid>\d+)\((?P<process>[^)]*)\) (?P<action>\w+) (?P<assertion>\w+)')
+
+PMSET_EVENT_TYPES = {
+    'Sleep':        'sleep',
+    'Wake':         'wake',
+    'DarkWake':     'darkwake',
+    'Assertions':   'assertion',
+}
+
+
+class PMSetError(Exception):
+    pass
+
+
+class PMSetEvent(object):
+    """
+    One event line from pmset log
+    """
+    def __init__(self, timestamp, domain, message):
+        self.timestamp = timestamp
+        self.domain = domain
+        self.message = message
+        self.event_type = PMSET_EVENT_TYPES.get(domain, 'other')
+
+        self.reason = None
+        self.duration = None
+        self.power_source = None
+        self.charge = None
+        self.pid = None
+        self.process = None
+        self.action = None
+        self.assertion = None
+
+        if self.event_type == 'assertion':
+            m = RE_PMSET_ASSERTION.match(message)
+            if m:
+                self.pid = int(m.group('pid'))
+                self.process = m.group('process')
+                self.action = m.group('action')
+                self.assertion = m.group('assertion')
+            return
+
+        if self.event_type == 'other':
+            return
+
+        m = RE_PMSET_DURATION.search(message)
+        if m:
+            self.duration = int(m.group('duration'))
+
+        m = RE_PMSET_POWER_SOURCE.search(message)
+        if m:
+            self.power_source = m.group('source') == 'AC' and 'AC' or 'Battery'
+
+        m = RE_PMSET_CHARGE.search(message)
+        if m:
+            self.charge = int(m.group('charge'))
+
+        if self.event_type == 'sleep':
+            m = RE_PMSET_SLEEP_REASON.search(message)
+        else:
+            m = RE_PMSET_WAKE_REASON.search(message)
+        if m:
+            self.reason = m.group('reason').strip()
+
+    def __repr__(self):
+        return '{0} {1} {2}'.format(
+            self.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
+            self.event_type,
+            self.reason is not None and self.reason or self.message,
+        )
+
+
+def parse_pmset_log(lines, event_types=None):
+    """
+    Generator to parse PMSetEvent items from pmset log lines
+
+    Lines may be str or bytes. Lines not matching the event format are skipped.
+    If event_types is given, other events are not parsed.
+    """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8', 'replace')
+
+        m = RE_PMSET_LINE.match(line.rstrip())
+        if not m:
+            continue
+
+        domain = m.group('domain')
+        if event_types is not None and PMSET_EVENT_TYPES.get(domain, 'other') not in event_types:
+            continue
+
+        try:
+            timestamp = datetime.strptime(m.group('timestamp'), PMSET_TIME_FORMAT)
+        except ValueError:
+            continue
+
+        yield PMSetEvent(timestamp, domain, m.group('message'))
+
+
+def pmset_log_events(event_types=None):
+    """
+    Generator to parse events from output of 'pmset -g log' as it is read
+    """
+    cmd = (PMSET_COMMAND, '-g', 'log')
+    try:
+        p = Popen(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    except OSError as e:
+        raise PMSetError('Error running {0}: {1}'.format(' '.join(cmd), e))
+
+    try:
+        for event in parse_pmset_log(p.stdout, event_types):
+            yield event
+    finally:
+        p.stdout.close()
+        p.wait()
+
+
+class PMSetLogSummary(object):
+    """
+    Aggregated statistics from pmset events, computed in one pass
+
+    Sleep periods are counted from a sleep event to the following wake or
+    darkwake event and split over local calendar days of the log.
+    """
+    def __init__(self, events=None):
+        self.event_counts = Counter()
+        self.wake_reasons = Counter()
+        self.sleep_reasons = Counter()
+        self.assertions = Counter()
+        self.asleep_per_day = {}
+        self.first = None
+        self.last = None
+        self.__sleep_started__ = None
+
+        if events is not None:
+            for event in events:
+                self.add(event)
+
+    def __repr__(self):
+        return 'PMSetLogSummary {0:d} events'.format(sum(self.event_counts.values()))
+
+    def add(self, event):
+        """
+        Add an event to summary
+        """
+        if self.first is None:
+            self.first = event.timestamp
+        self.last = event.timestamp
+        self.event_counts[event.event_type] += 1
+
+        if event.event_type == 'sleep':
+            self.__sleep_started__ = event.timestamp
+            if event.reason is not None:
+                self.sleep_reasons[event.reason] += 1
+
+        elif event.event_type in ('wake', 'darkwake'):
+            if event.reason is not None:
+                self.wake_reasons[event.reason] += 1
+            if self.__sleep_started__ is not None:
+                self.__add_sleep__(self.__sleep_started__, event.timestamp)
+                self.__sleep_started__ = None
+
+        elif event.event_type == 'assertion' and event.action == 'Created':
+            self.assertions[(event.process, event.assertion)] += 1
+
+    def __add_sleep__(self, start, end):
+        """
+        Add sleep period to per day totals, splitting it at midnight
+        """
+        while start < end:
+            day = start.date()
+            midnight = start.replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+            period_end = min(end, midnight)
+            self.asleep_per_day[day] = self.asleep_per_day.get(day, 0) + (period_end - start).total_seconds()
+            start = period_end
+
+    def top_wake_reasons(self, count=10):
+        """
+        Return list of (reason, count) for most common wake reasons
+        """
+        return self.wake_reasons.most_common(count)
+
+    def top_assertions(self, count=10):
+        """
+        Return list of ((process, assertion), count) for most common created assertions
+        """
+        return self.assertions.most_common(count)
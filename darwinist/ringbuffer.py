@@ -0,0 +1,95 @@
+"""
+Fixed size ring buffers for sampled numeric values
+"""
+
+from array import array
+
+
+class RingBuffer(object):
+    """
+    Array backed ring buffer of numeric values
+
+    Storage is allocated once. When buffer is full, appending overwrites
+    the oldest value.
+    """
+    def __init__(self, size, typecode='d'):
+        if size < 1:
+            raise ValueError('Invalid ring buffer size: {0}'.format(size))
+
+        self.size = size
+        self.data = array(typecode, [0]) * size
+        self.index = 0
+        self.count = 0
+
+    def __repr__(self):
+        return 'RingBuffer {0:d}/{1:d} values'.format(self.count, self.size)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        start = (self.index - self.count) % self.size
+        for i in range(self.count):
+            yield self.data[(start + i) % self.size]
+
+    def append(self, value):
+        """
+        Append a value, overwriting oldest value if buffer is full
+        """
+        self.data[self.index] = value
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def clear(self):
+        """
+        Remove all values from buffer
+        """
+        self.index = 0
+        self.count = 0
+
+    @property
+    def first(self):
+        if not self.count:
+            return None
+        return self.data[(self.index - self.count) % self.size]
+
+    @property
+    def last(self):
+        if not self.count:
+            return None
+        return self.data[(self.index - 1) % self.size]
+
+    def values(self):
+        """
+        Return values as list, from oldest to newest
+        """
+        return list(self)
+
+    def min(self):
+        if not self.count:
+            return None
+        return min(self)
+
+    def max(self):
+        if not self.count:
+            return None
+        return max(self)
+
+    def mean(self):
+        if not self.count:
+            return None
+        return float(sum(self)) / self.count
+
+    def percentile(self, percent):
+        """
+        Return percentile of values with linear interpolation between values
+        """
+        if not self.count:
+            return None
+
+        values = sorted(self)
+        position = (len(values) - 1) * float(percent) / 100
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
@@ -0,0 +1,172 @@
+"""
+Sparse bundle disk image band usage analysis
+
+Band files in the bands/ directory of a sparse bundle are listed with
+os.scandir and checked with a thread pool. Summaries of previous scans are
+stored to report growth between scans.
+"""
+
+import json
+import math
+import os
+import plistlib
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from xml.parsers.expat import ExpatError
+
+DEFAULT_SUMMARY_PATH = os.path.expanduser('~/Library/Application Support/darwinist/sparsebundles.json')
+DEFAULT_JOBS = 8
+
+# Number of band entries checked by one worker task
+BAND_CHUNK_SIZE = 4096
+
+
+class SparseBundleError(Exception):
+    pass
+
+
+class SparseBundleUsage(dict):
+    """
+    Band usage summary for a sparse bundle
+    """
+    def __getattr__(self, attr):
+        try:
+            return self[attr]
+        except KeyError:
+            raise AttributeError('No such SparseBundleUsage attribute: {0}'.format(attr))
+
+    def __repr__(self):
+        return '{0} {1:d} bands {2:d} bytes allocated'.format(self.path, self.bands, self.allocated)
+
+
+class SparseBundleSummaries(dict):
+    """
+    Persisted usage summaries of previous scans by sparse bundle path
+    """
+    def __init__(self, path=DEFAULT_SUMMARY_PATH):
+        self.path = path
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as fd:
+                    self.update(json.load(fd))
+            except (IOError, OSError, ValueError) as e:
+                raise SparseBundleError('Error reading {0}: {1}'.format(self.path, e))
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.path, 'w') as fd:
+                json.dump(self, fd, indent=2, sort_keys=True)
+        except (IOError, OSError) as e:
+            raise SparseBundleError('Error writing {0}: {1}'.format(self.path, e))
+
+
+def __band_usage__(entries):
+    """
+    Return tuple (bands, empty bands, allocated bytes, apparent bytes) for entries
+    """
+    bands = empty = allocated = apparent = 0
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        bands += 1
+        if st.st_blocks == 0:
+            empty += 1
+        allocated += st.st_blocks * 512
+        apparent += st.st_size
+    return bands, empty, allocated, apparent
+
+
+class SparseBundle(object):
+    """
+    Sparse bundle disk image directory
+    """
+    def __init__(self, path):
+        self.path = os.path.realpath(path)
+        self.bands_path = os.path.join(self.path, 'bands')
+
+        if not os.path.isdir(self.bands_path):
+            raise SparseBundleError('Not a sparse bundle: {0}'.format(path))
+
+        self.__info__ = None
+
+    def __repr__(self):
+        return self.path
+
+    @property
+    def info(self):
+        """
+        Parsed Info.plist of the bundle
+        """
+        if self.__info__ is None:
+            path = os.path.join(self.path, 'Info.plist')
+            try:
+                with open(path, 'rb') as fd:
+                    self.__info__ = plistlib.load(fd)
+            except (IOError, OSError, ExpatError, ValueError) as e:
+                raise SparseBundleError('Error reading {0}: {1}'.format(path, e))
+        return self.__info__
+
+    @property
+    def band_size(self):
+        return self.info.get('band-size', None)
+
+    @property
+    def size(self):
+        return self.info.get('size', None)
+
+    def analyze(self, jobs=DEFAULT_JOBS, summaries=None):
+        """
+        Scan band files and return SparseBundleUsage
+
+        If summaries is given, growth since previous scan is reported and
+        the summary for this bundle is updated. Summaries are not saved.
+        """
+        chunks = []
+        chunk = []
+        try:
+            for entry in os.scandir(self.bands_path):
+                chunk.append(entry)
+                if len(chunk) >= BAND_CHUNK_SIZE:
+                    chunks.append(chunk)
+                    chunk = []
+        except OSError as e:
+            raise SparseBundleError('Error scanning {0}: {1}'.format(self.bands_path, e))
+        if chunk:
+            chunks.append(chunk)
+
+        bands = empty = allocated = apparent = 0
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for result in executor.map(__band_usage__, chunks):
+                bands += result[0]
+                empty += result[1]
+                allocated += result[2]
+                apparent += result[3]
+
+        usage = SparseBundleUsage(
+            path=self.path,
+            timestamp=time.time(),
+            size=self.size,
+            band_size=self.band_size,
+            bands=bands,
+            empty_bands=empty,
+            empty_ratio=bands and float(empty) / bands or 0.0,
+            allocated=allocated,
+            apparent=apparent,
+        )
+        if self.size and self.band_size:
+            usage['max_bands'] = int(math.ceil(float(self.size) / self.band_size))
+
+        if summaries is not None:
+            previous = summaries.get(self.path, None)
+            if previous is not None:
+                usage['growth'] = allocated - previous['allocated']
+                usage['growth_seconds'] = usage['timestamp'] - previous['timestamp']
+            summaries[self.path] = dict(usage)
+
+        return usage